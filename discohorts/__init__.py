@@ -12,8 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .discohort import Discohort
-from .config import Config, EpidiscoConfig
+from .discohort import Discohort, PatientView, Populator
+from .config import Config, EpidiscoConfig, PatientFilter
 
 from ._version import get_versions
 __version__ = get_versions()['version']
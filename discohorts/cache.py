@@ -0,0 +1,92 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os import path, makedirs, listdir, remove, utime
+import hashlib
+import json
+import time
+
+from .utils import atomic_write
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_entries=10000, max_age_days=30):
+        """
+        An on-disk cache of JSON-serializable populate results, one file per key.
+
+        Keys should include everything the result depends on (e.g. the size and mtime
+        of the files it was parsed from), so that changed outputs are re-parsed.
+
+        evict removes entries older than max_age_days, and then the least recently used
+        entries beyond max_entries.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        if not path.exists(cache_dir):
+            makedirs(cache_dir)
+
+    def key(self, *parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return path.join(self.cache_dir, "{}.json".format(key))
+
+    def get(self, key):
+        """
+        Returns the cached value, or None if there is no (unexpired) entry.
+        """
+        entry_path = self.entry_path(key)
+        try:
+            if time.time() - path.getmtime(entry_path) > self.max_age_days * 24 * 60 * 60:
+                remove(entry_path)
+                return None
+            with open(entry_path) as f:
+                value = json.load(f)
+            # Mark the entry as recently used.
+            utime(entry_path, None)
+            return value
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        entry_path = self.entry_path(key)
+        with atomic_write(entry_path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+
+    def evict(self):
+        """
+        Apply the eviction policy, returning the number of entries removed.
+        """
+        now = time.time()
+        entries = []
+        for name in listdir(self.cache_dir):
+            if name.endswith(".json"):
+                entry_path = path.join(self.cache_dir, name)
+                try:
+                    entries.append((path.getmtime(entry_path), entry_path))
+                except OSError:
+                    continue
+
+        entries.sort(reverse=True)
+        num_removed = 0
+        for i, (mtime, entry_path) in enumerate(entries):
+            if i >= self.max_entries or now - mtime > self.max_age_days * 24 * 60 * 60:
+                try:
+                    remove(entry_path)
+                    num_removed += 1
+                except OSError:
+                    pass
+        return num_removed
@@ -0,0 +1,121 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+from os import path, listdir, scandir, lstat, remove
+from shutil import rmtree
+import pandas as pd
+
+# Children of a biokepi work dir that are shared by every run, rather than intermediates.
+SHARED_WORK_DIR_NAMES = ["toolkit", "pyensembl-cache", "reference-genome", "results"]
+WORK_DIR_USAGE_COLUMNS = ["work_dir", "path", "run_name", "bytes", "mtime"]
+
+
+def tree_usage(tree_path):
+    """
+    Disk usage (allocated bytes) and newest mtime of a file or directory tree, from a
+    scandir traversal that doesn't follow symlinks.
+    """
+    def entry_usage(entry_stat):
+        blocks = getattr(entry_stat, "st_blocks", None)
+        return blocks * 512 if blocks is not None else entry_stat.st_size
+
+    try:
+        root_stat = lstat(tree_path)
+    except OSError:
+        return 0, None
+    total = entry_usage(root_stat)
+    newest = root_stat.st_mtime
+    if not path.isdir(tree_path) or path.islink(tree_path):
+        return total, newest
+
+    stack = [tree_path]
+    while stack:
+        try:
+            entries = list(scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                entry_stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            total += entry_usage(entry_stat)
+            newest = max(newest, entry_stat.st_mtime)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+    return total, newest
+
+
+def match_run_name(name, run_names, delims):
+    """
+    The run name that a work dir child's name belongs to: the name itself, or the longest
+    prefix of it made of whole tokens, i.e. followed by a delimiter (or "."), so that
+    "lung_1" matches "lung_1_rna" and "lung_1.log" but not "lung_10"; None if there is
+    none. Pass every registered pipeline's run names, so that the longest one wins.
+    """
+    if name in run_names:
+        return name
+    for i in range(len(name) - 1, 0, -1):
+        if (name[i] in delims or name[i] == ".") and name[:i] in run_names:
+            return name[:i]
+    return None
+
+
+def work_dir_usage(work_dirs, run_names, delims, max_workers=16):
+    """
+    Disk usage of every child of work_dirs (other than SHARED_WORK_DIR_NAMES), with the
+    run name it belongs to, if any, as a DataFrame of work_dir, path, run_name, bytes
+    and mtime (the newest in its tree).
+
+    Work dirs are listed concurrently, and then every child is measured concurrently.
+    """
+    run_names = set(run_names)
+
+    def list_work_dir(work_dir):
+        try:
+            names = sorted(listdir(work_dir))
+        except OSError:
+            return []
+        return [(work_dir, path.join(work_dir, name), match_run_name(name, run_names, delims))
+                for name in names if name not in SHARED_WORK_DIR_NAMES]
+
+    def measure(child):
+        work_dir, child_path, run_name = child
+        num_bytes, mtime = tree_usage(child_path)
+        return {"work_dir": work_dir, "path": child_path, "run_name": run_name,
+                "bytes": num_bytes, "mtime": mtime}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        children = [child for listed in executor.map(list_work_dir, work_dirs)
+                    for child in listed]
+        rows = list(executor.map(measure, children))
+    finally:
+        executor.shutdown()
+    return pd.DataFrame(rows, columns=WORK_DIR_USAGE_COLUMNS)
+
+
+def remove_path(target_path):
+    """
+    Remove a file or directory tree, returning whether it was removed.
+    """
+    try:
+        if path.isdir(target_path) and not path.islink(target_path):
+            rmtree(target_path)
+        else:
+            remove(target_path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,159 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+from os import path, makedirs, link, remove, stat
+from shutil import copystat
+from threading import Lock, Semaphore
+import errno
+import fcntl
+import os
+import time
+import pandas as pd
+
+from .utils import scan_results_files, atomic_write
+
+# Linux's FICLONE ioctl, which makes a copy-on-write clone (reflink) of a file.
+FICLONE = 0x40049409
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+class RateLimiter(object):
+    def __init__(self, max_bytes_per_sec=None):
+        """
+        Limit throughput to max_bytes_per_sec across all threads sharing this limiter.
+        """
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.lock = Lock()
+        self.next_time = time.time()
+
+    def consume(self, num_bytes):
+        if not self.max_bytes_per_sec:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + float(num_bytes) / self.max_bytes_per_sec
+            wait_secs = self.next_time - now
+        if wait_secs > 0:
+            time.sleep(wait_secs)
+
+
+def is_up_to_date(src_stat, dst_path):
+    try:
+        dst_stat = stat(dst_path)
+    except OSError:
+        return False
+    return dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime >= src_stat.st_mtime
+
+
+def copy_data(src_path, dst_path, rate_limiter):
+    """
+    Copy file contents, by reflink if the filesystem supports it, then copy_file_range,
+    and otherwise large-buffer reads and writes. Returns the method used.
+    """
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except (IOError, OSError):
+            pass
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while True:
+                    num_copied = os.copy_file_range(src.fileno(), dst.fileno(), COPY_BUFFER_SIZE)
+                    if num_copied == 0:
+                        return "copy_file_range"
+                    rate_limiter.consume(num_copied)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+
+        while True:
+            data = src.read(COPY_BUFFER_SIZE)
+            if not data:
+                return "copy"
+            rate_limiter.consume(len(data))
+            dst.write(data)
+
+
+def collect_file(src_path, dst_path, rate_limiter, hardlink=True):
+    """
+    Bring dst_path up to date with src_path, returning (method, bytes copied): method is
+    "skipped" if it was already up to date, "hardlink" if it was linked (when hardlink is
+    True and both are on the same filesystem), or else the copy_data method.
+    """
+    src_stat = stat(src_path)
+    if is_up_to_date(src_stat, dst_path):
+        return "skipped", 0
+
+    dst_dir = path.dirname(dst_path)
+    try:
+        makedirs(dst_dir)
+    except OSError:
+        if not path.isdir(dst_dir):
+            raise
+
+    if hardlink and stat(dst_dir).st_dev == src_stat.st_dev:
+        with atomic_write(dst_path) as tmp_path:
+            remove(tmp_path)
+            link(src_path, tmp_path)
+        return "hardlink", 0
+
+    with atomic_write(dst_path) as tmp_path:
+        method = copy_data(src_path, tmp_path, rate_limiter)
+        copystat(src_path, tmp_path)
+    return method, src_stat.st_size
+
+
+def collect_trees(trees, max_workers=16, max_per_source=4, max_bytes_per_sec=None,
+                  hardlink=True):
+    """
+    Collect every file of each (key, source, src_dir, dst_dir) in trees into dst_dir,
+    mirroring its layout, on a pool of max_workers threads.
+
+    Per source (e.g. an NFS server), at most max_per_source trees are listed or files are
+    copied at once, at up to max_bytes_per_sec. Hidden and temporary files (see
+    RESULTS_PRUNE_PATTERNS) are left out. Returns a DataFrame of key, source, path, method
+    and bytes for every file.
+    """
+    sources = set(source for (_, source, _, _) in trees)
+    semaphores = dict((source, Semaphore(max_per_source)) for source in sources)
+    rate_limiters = dict((source, RateLimiter(max_bytes_per_sec)) for source in sources)
+
+    def list_tree(tree):
+        key, source, src_dir, dst_dir = tree
+        with semaphores[source]:
+            return [(key, source, entry.path,
+                     path.join(dst_dir, path.relpath(entry.path, src_dir)))
+                    for entry in scan_results_files(src_dir)]
+
+    def collect_task(task):
+        key, source, src_path, dst_path = task
+        with semaphores[source]:
+            method, num_bytes = collect_file(
+                src_path, dst_path, rate_limiter=rate_limiters[source], hardlink=hardlink)
+        return {"key": key, "source": source, "path": dst_path, "method": method,
+                "bytes": num_bytes}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        tasks = [task for tree_tasks in executor.map(list_tree, trees) for task in tree_tasks]
+        rows = list(executor.map(collect_task, tasks))
+    finally:
+        executor.shutdown()
+    return pd.DataFrame(rows, columns=["key", "source", "path", "method", "bytes"])
@@ -16,6 +16,50 @@ from __future__ import print_function
 from types import FunctionType
 
 
+def patient_column(patient, column):
+    """
+    Look up a clinical column on a Patient: either a Patient attribute (e.g. "benefit")
+    or a key in patient.additional_data.
+    """
+    if hasattr(patient, column):
+        return getattr(patient, column)
+    additional_data = getattr(patient, "additional_data", None) or {}
+    if column in additional_data:
+        return additional_data[column]
+    raise ValueError("Patient {} has no column {}".format(patient.id, column))
+
+
+class PatientFilter(object):
+    def __init__(self, ids=None, **columns):
+        """
+        A declarative keep predicate on patient IDs and/or clinical columns, e.g.
+        PatientFilter(ids=["468"]) or PatientFilter(benefit=True).
+
+        Column values can be plain values (compared with ==) or f(value) functions.
+
+        Unlike an arbitrary f(patient), a PatientFilter lets Discohort look patients up
+        by ID without iterating over (or loading data for) the rest of the Cohort.
+        """
+        self.ids = None if ids is None else set(str(patient_id) for patient_id in ids)
+        self.columns = columns
+
+    def __call__(self, patient):
+        if self.ids is not None and str(patient.id) not in self.ids:
+            return False
+        for column, expected in self.columns.items():
+            value = patient_column(patient, column)
+            if callable(expected):
+                if not expected(value):
+                    return False
+            elif value != expected:
+                return False
+        return True
+
+    def __repr__(self):
+        return "PatientFilter(ids={}, columns={})".format(
+            None if self.ids is None else sorted(self.ids), self.columns)
+
+
 class Config(object):
     def __init__(self, discohort=None, **kwargs):
         """
@@ -26,6 +70,8 @@ class Config(object):
 
         Any argument to the CLI needs to be prefixed with "arg_".
 
+        keep can also be a PatientFilter, which is used as-is.
+
         If Discohort is None, the user is expected to provide it later.
         """
         self.discohort = discohort
@@ -36,7 +82,7 @@ class Config(object):
         if key == "given_work_dir":
             raise ValueError("Cannot replace given_work_dir in __init__")
 
-        if type(value) == FunctionType:
+        if type(value) == FunctionType or isinstance(value, PatientFilter):
             self.__dict__[key] = value
         else:
             self.__dict__[key] = lambda patient: value
@@ -52,6 +98,25 @@ class Config(object):
         # in __init__ becauase it isn't of the form f(patient).
         pass
 
+    def required_args(self, patient):
+        """
+        arg_* arguments that must not be None for the patient, checked by Pipeline.validate.
+        """
+        return []
+
+    def input_paths(self, patient):
+        """
+        Paths to the patient's inputs (e.g. BAMs), used to fingerprint launches: by default,
+        the values of any arg_*_input arguments.
+        """
+        input_paths = []
+        for attr in dir(self):
+            if attr.startswith("arg_") and attr.endswith("_input"):
+                value = getattr(self, attr)(patient)
+                if value is not None:
+                    input_paths.append(value)
+        return input_paths
+
     def arg_name(self, patient):
         return None
 
@@ -69,6 +134,9 @@ class Config(object):
 
 
 class EpidiscoConfig(Config):
+    def required_args(self, patient):
+        return ["arg_normal_input", "arg_tumor_input"]
+
     def arg_normal_input(self, patient):
         assert patient.normal_sample is not None, "Patient {} has no normal sample".format(patient)
         return patient.normal_sample.bam_path_dna
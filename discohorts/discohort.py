@@ -15,21 +15,97 @@
 from __future__ import print_function
 
 from copy import copy
-from os import path, listdir, makedirs
+from functools import partial
+from itertools import product
+from fnmatch import fnmatch
+import hashlib
+import re
+import time
+from os import path, listdir, makedirs, scandir
 from shutil import copy2, move
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from cohorts import Cohort
 import pandas as pd
 
-from .pipeline import Pipeline
-from .utils import find_files_recursive, find_patient, run_hlarp, get_logger
-from .config import EpidiscoConfig
+from .cache import ResultCache
+from .index import ResultsIndex, ResultsListing, classify_artifacts
+from .lazy import set_lazy, pending_attrs, set_loaded
+from .streaming import stream_results
+from .parsers import read_optitype, read_seq2hla
+from .hla import HLA_CALLERS, hla_attr, hla_calls, hla_consensus
+from .collect import collect_trees
+from .history import RunHistory
+from .progress import Progress
+from .watch import ChangeWaiter
+from .cleanup import SHARED_WORK_DIR_NAMES, match_run_name, work_dir_usage, remove_path
+from .verify import Manifest, verify_trees
+from .variants import load_variants, concat_variant_tables
+from .expression import find_kallisto_abundance, build_expression_matrix
+from .pipeline import Pipeline, assign_work_dirs, render_keyword_args
+from .utils import (find_files_known_layouts, file_stats, scan_tree, PatientIndex, run_hlarp,
+                    get_logger, scan_patient_dirs, add_patient_path, RESULTS_PRUNE_PATTERNS)
+from .config import EpidiscoConfig, PatientFilter
 
 DEFAULT_ID_DELIMS = ["_", "-"]
+DEFAULT_CACHE_DIR = path.join(path.expanduser("~"), ".discohorts")
+
+# HLA result files, by caller.
+HLA_RESULT_PATTERNS = {
+    "optitype": "*.tsv",
+    "seq2hla": "*-ClassI.HLAgenotype4digits",
+}
+
+# Where biokepi/Epidisco put HLA results, relative to a patient's results dir.
+HLA_LAYOUTS = [
+    "*{caller}*/{pattern}",
+    "*{caller}*/*/{pattern}",
+    "*/*{caller}*/{pattern}",
+    "*/*{caller}*/*/{pattern}",
+]
+
+# Where biokepi writes a run's outputs, relative to its work dir.
+WORK_DIR_RESULTS = "results"
+
+# The samples OptiType is run on by Epidisco; see EpidiscoConfig.arg_with_optitype_*.
+OPTITYPE_SAMPLES = ["normal", "tumor", "rna"]
 
 logger = get_logger(__name__)
 
 
+class PatientView(object):
+    def __init__(self, cohort, patients):
+        """
+        A lightweight, Cohort-like view over a subset of a Cohort's patients.
+
+        Cohort load_* methods (e.g. load_variants) are restricted to the patients in
+        the view, so only their data is loaded.
+        """
+        self.cohort = cohort
+        self.patients = patients
+
+    def __iter__(self):
+        return iter(self.patients)
+
+    def __len__(self):
+        return len(self.patients)
+
+    def __getitem__(self, index):
+        return self.patients[index]
+
+    def __getattr__(self, name):
+        if name.startswith("load_"):
+            load_fn = getattr(self.cohort, name)
+            def load_view(*args, **kwargs):
+                kwargs.setdefault("patients", self.patients)
+                return load_fn(*args, **kwargs)
+            return load_view
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return "PatientView({} patients)".format(len(self.patients))
+
+
 class Discohort(object):
     def __init__(self,
                  cohort,
@@ -37,19 +113,66 @@ class Discohort(object):
                  biokepi_results_dirs=[],
                  id_delims=DEFAULT_ID_DELIMS,
                  batch_size=50,
-                 batch_wait_secs=0):
+                 batch_wait_secs=0,
+                 cache_dir=DEFAULT_CACHE_DIR,
+                 dest_results_dir=None):
         if len(biokepi_work_dirs) < 1:
             raise ValueError(
                 "Need at least one work dir, but work_dirs = {}".format(biokepi_work_dirs))
 
         self.cohort = cohort
         self.pipelines = {}
+        self.sweeps = {}
         self.is_processed = False
         self.biokepi_work_dirs = biokepi_work_dirs
         self.biokepi_results_dirs = biokepi_results_dirs
         self.id_delims = id_delims
         self.batch_size = batch_size
         self.batch_wait_secs = batch_wait_secs
+        self.cache_dir = cache_dir
+        self.dest_results_dir = dest_results_dir
+        self._patients_by_id = None
+        self._patient_index = None
+        self._results_index = None
+        self._results_index_refreshed = False
+        self._populate_cache = None
+        self._run_history = None
+
+    def patient_index(self, patients=None):
+        """
+        A PatientIndex for matching file/folder names to patients (by default, the
+        whole Cohort's).
+        """
+        if patients is not None and patients is not self.cohort:
+            return PatientIndex(patients, self.id_delims)
+        if self._patient_index is None or self._patient_index.id_delims != self.id_delims:
+            self._patient_index = PatientIndex(self.cohort, self.id_delims)
+        return self._patient_index
+
+    def view(self, keep=None):
+        """
+        Return a PatientView of the patients that satisfy keep, which is either
+        an f(patient) function or a PatientFilter.
+
+        With a PatientFilter on IDs, patients are looked up by ID rather than
+        by evaluating keep on every patient in the Cohort.
+        """
+        if keep is None:
+            return PatientView(self.cohort, list(self.cohort))
+
+        if isinstance(keep, PatientFilter) and keep.ids is not None:
+            if self._patients_by_id is None:
+                self._patients_by_id = defaultdict(list)
+                for i, patient in enumerate(self.cohort):
+                    self._patients_by_id[str(patient.id)].append((i, patient))
+            # Keep Cohort order, so e.g. work dir assignment doesn't depend on how keep is written.
+            candidates = [patient for _, patient in sorted(
+                [item for patient_id in keep.ids for item in self._patients_by_id.get(patient_id, [])],
+                key=lambda item: item[0])]
+        else:
+            candidates = self.cohort
+
+        return PatientView(self.cohort, [patient for patient in candidates if keep(patient)])
 
     def add_epidisco_pipeline(self,
                               pipeline_name,
@@ -64,6 +187,43 @@ class Discohort(object):
         return self.add_pipeline(
             pipeline_name=pipeline_name, config=config, pipeline_path=pipeline_path)
 
+    def add_sweep(self,
+                  sweep_name,
+                  base_config=None,
+                  grid={},
+                  pipeline_path="run_pipeline.ml"):
+        """
+        Expand a parameter grid, e.g. {"arg_picard_java_max_heap_size": ["8g", "20g"]},
+        into one Epidisco pipeline per grid point, named <sweep_name>_0, <sweep_name>_1, etc.
+
+        Each grid point's run name is derived from the patient and its rendered keyword
+        arguments, so grid points that render identically for a patient share a run (and
+        therefore its results) when run via run_sweep.
+
+        Returns the names of the added pipelines.
+        """
+        if sweep_name in self.sweeps:
+            raise ValueError("Sweep already exists: {}".format(sweep_name))
+        if base_config is None:
+            base_config = EpidiscoConfig(self)
+
+        keys = sorted(grid.keys())
+        pipeline_names = []
+        for i, values in enumerate(product(*[grid[key] for key in keys])):
+            config = copy(base_config)
+            for key, value in zip(keys, values):
+                config.update(key, value)
+            pipeline_name = "{}_{}".format(sweep_name, i)
+            self.add_epidisco_pipeline(
+                pipeline_name=pipeline_name,
+                config=config,
+                run_name=sweep_run_name(sweep_name, config),
+                pipeline_path=pipeline_path)
+            pipeline_names.append(pipeline_name)
+
+        self.sweeps[sweep_name] = pipeline_names
+        return pipeline_names
+
     def add_pipeline(self, pipeline_name, config, pipeline_path):
         if pipeline_name in self.pipelines:
             raise ValueError("Pipeline already exists: {}".format(pipeline_name))
@@ -75,105 +235,1019 @@ class Discohort(object):
             config=config,
             pipeline_path=pipeline_path,
             batch_size=self.batch_size,
-            batch_wait_secs=self.batch_wait_secs)
+            batch_wait_secs=self.batch_wait_secs,
+            name=pipeline_name)
         self.pipelines[pipeline_name] = pipeline
 
-    def run_pipeline(self, pipeline_name, skip_num=0, wait_after_all=False, dry_run=False):
+    def run_pipeline(self, pipeline_name, skip_num=0, wait_after_all=False, dry_run=False,
+                     only_changed=False, progress=True, target_per_min=None):
+        """
+        If only_changed is True, only launch patients whose command, pipeline script or
+        inputs changed since their last successful launch.
+
+        If progress is True, report launch throughput and ETA; see Pipeline.run.
+        """
         if pipeline_name not in self.pipelines:
             raise ValueError(
                 "Trying to run a pipeline that does not exist: {}".format(pipeline_name))
 
         pipeline = self.pipelines[pipeline_name]
-        pipeline.run(self, skip_num=skip_num, wait_after_all=wait_after_all, dry_run=dry_run)
+        pipeline.run(self, skip_num=skip_num, wait_after_all=wait_after_all, dry_run=dry_run,
+                     only_changed=only_changed, progress=progress, target_per_min=target_per_min)
+
+    def export_job_array(self, pipeline_name, tasks_path, format="parallel",
+                         only_changed=False):
+        """
+        Write a pipeline's commands to a task file for GNU parallel, xargs or an array
+        job; see Pipeline.export_job_array.
+        """
+        if pipeline_name not in self.pipelines:
+            raise ValueError(
+                "Trying to export a pipeline that does not exist: {}".format(pipeline_name))
+
+        return self.pipelines[pipeline_name].export_job_array(
+            self, tasks_path, format=format, only_changed=only_changed)
+
+    def validate_pipeline(self, pipeline_name, known_args=None):
+        """
+        Lint a pipeline's config across every kept patient; see Pipeline.validate.
+        """
+        if pipeline_name not in self.pipelines:
+            raise ValueError(
+                "Trying to validate a pipeline that does not exist: {}".format(pipeline_name))
+
+        return self.pipelines[pipeline_name].validate(self, known_args=known_args)
+
+    def run_sweep(self, sweep_name, wait_after_all=False, dry_run=False, only_changed=False,
+                  progress=True):
+        """
+        Run every pipeline in a sweep. Each patient gets a single work dir across the
+        whole sweep, and each distinct (work dir, command) pair is only run once.
+        """
+        if sweep_name not in self.sweeps:
+            raise ValueError("Trying to run a sweep that does not exist: {}".format(sweep_name))
+
+        pipelines = [self.pipelines[pipeline_name] for pipeline_name in self.sweeps[sweep_name]]
+        kept_patients = set()
+        for pipeline in pipelines:
+            kept_patients.update(self.view(pipeline.config.keep))
+        patient_to_work_dir = assign_work_dirs(
+            [patient for patient in self.cohort if patient in kept_patients],
+            self.biokepi_work_dirs)
+
+        launched = {}
+        for pipeline in pipelines:
+            pipeline.run(self, skip_num=0, wait_after_all=wait_after_all, dry_run=dry_run,
+                         only_changed=only_changed, patient_to_work_dir=patient_to_work_dir,
+                         launched=launched, progress=progress)
+        print("Ran {} distinct commands for sweep {}".format(len(launched), sweep_name))
+
+    def run_results_dirs(self):
+        """
+        Every directory that may hold runs' results, in <run name> subdirectories: each
+        work dir's results, the results dirs and dest_results_dir.
+        """
+        return ([path.join(work_dir, WORK_DIR_RESULTS) for work_dir in self.biokepi_work_dirs] +
+                list(self.biokepi_results_dirs) +
+                ([self.dest_results_dir] if self.dest_results_dir is not None else []))
+
+    def status(self, pipeline_names=None, complete_artifacts=["variants"], stall_hours=24,
+               max_workers=16):
+        """
+        A DataFrame of the state of each registered pipeline (columns) for each patient
+        (rows; missing where the pipeline doesn't keep the patient, or has no run name
+        for it):
+
+        - "done": a results dir of its run has every one of complete_artifacts.
+        - "running": it was launched, or has intermediates in a work dir, and the newest
+          of its launch time and intermediate and results mtimes is within stall_hours.
+        - "failed": as for running, but with no activity within stall_hours.
+        - "never launched": none of the above.
+
+        Work dirs and results dirs are scanned concurrently, one task per dir, and each
+        run's intermediates and results are read from the ResultsIndex, so polling only
+        lists directories that changed since the last call. Files that grow in place
+        don't change their directory's mtime, so activity is detected by files being
+        created.
+
+        Completion times of done runs (their results' newest mtime) are recorded in the
+        RunHistory.
+        """
+        if pipeline_names is None:
+            pipeline_names = sorted(self.pipelines.keys())
+        for pipeline_name in pipeline_names:
+            if pipeline_name not in self.pipelines:
+                raise ValueError("No such pipeline: {}".format(pipeline_name))
+
+        run_names = {}
+        launch_times = {}
+        history = self.run_history()
+        for pipeline_name in pipeline_names:
+            pipeline = self.pipelines[pipeline_name]
+            pipeline_launch_times = history.last_launched(pipeline_name)
+            unnamed = []
+            for patient in self.view(pipeline.config.keep):
+                try:
+                    run_name = pipeline.run_name(patient)
+                except ValueError:
+                    unnamed.append(patient.id)
+                    continue
+                run_names[(patient, pipeline_name)] = run_name
+                launch_time = pipeline_launch_times.get(str(patient.id))
+                if launch_time is not None:
+                    launch_times[run_name] = max(launch_time, launch_times.get(run_name, 0))
+            if unnamed:
+                logger.warning(
+                    "Pipeline {} has no run name for {} patients, so their status is unknown".
+                    format(pipeline_name, len(unnamed)))
+        all_run_names = set(run_names.values())
+        # Match work dir children against every pipeline's run names, so that e.g. "lung_1"
+        # doesn't claim another pipeline's "lung_1_rna".
+        registered_run_names = set(self.run_name_owners()) | all_run_names
+        results_index = self.results_index()
+
+        def scan_work_dir(work_dir):
+            # (run name, is complete, mtime) of each run's intermediates.
+            found = []
+            try:
+                entries = sorted(scandir(work_dir), key=lambda entry: entry.name)
+            except OSError:
+                return found
+            for entry in entries:
+                if entry.name in SHARED_WORK_DIR_NAMES:
+                    continue
+                run_name = match_run_name(entry.name, registered_run_names, self.id_delims)
+                if run_name not in all_run_names:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    results_index.refresh(entry.path)
+                    mtime = results_index.newest_mtime(entry.path)
+                else:
+                    mtime = entry.stat(follow_symlinks=False).st_mtime
+                found.append((run_name, False, mtime))
+            return found
+
+        def scan_results_dir(results_dir):
+            # (run name, is complete, mtime) of each run's results.
+            found = []
+            try:
+                names = sorted(listdir(results_dir))
+            except OSError:
+                return found
+            for run_name in names:
+                if run_name not in all_run_names:
+                    continue
+                run_path = path.join(results_dir, run_name)
+                results_index.refresh(run_path)
+                artifacts = classify_artifacts(run_path, [
+                    file_path for (file_path, _, _) in results_index.find_files(run_path)])
+                found.append((run_name, all(artifacts[artifact] for artifact in complete_artifacts),
+                              results_index.newest_mtime(run_path)))
+            return found
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            scans = ([executor.submit(scan_work_dir, work_dir)
+                      for work_dir in self.biokepi_work_dirs] +
+                     [executor.submit(scan_results_dir, results_dir)
+                      for results_dir in self.run_results_dirs()])
+            found = [item for scan in scans for item in scan.result()]
+        finally:
+            executor.shutdown()
+
+        completed_at = {}
+        last_activity = dict(launch_times)
+        for run_name, is_complete, mtime in found:
+            if is_complete:
+                completed_at[run_name] = max(mtime or 0, completed_at.get(run_name, 0))
+            if mtime is not None:
+                last_activity[run_name] = max(mtime, last_activity.get(run_name, 0))
+
+        now = time.time()
+
+        def state(run_name):
+            if run_name in completed_at:
+                return "done"
+            if run_name not in last_activity:
+                return "never launched"
+            if now - last_activity[run_name] < stall_hours * 60 * 60:
+                return "running"
+            return "failed"
+
+        df = pd.DataFrame(index=pd.Index([patient.id for patient in self.cohort], name="patient_id"),
+                          columns=pipeline_names, dtype=object)
+        for (patient, pipeline_name), run_name in run_names.items():
+            df.at[patient.id, pipeline_name] = state(run_name)
+            if run_name in completed_at:
+                history.record_completion(pipeline_name, patient.id, completed_at[run_name])
+        return df
+
+    def collect_results(self, pipeline_name, max_workers=16, max_per_source=4,
+                        max_bytes_per_sec=None, hardlink=True):
+        """
+        Copy each kept patient's outputs for a pipeline, i.e. <work dir>/results/<run name>
+        in any of the work dirs, to <dest_results_dir>/<run name>.
+
+        Files whose copy is already up to date (same size, not older) are skipped. Files
+        on the same filesystem as dest_results_dir are hardlinked, if hardlink is True;
+        see collect_trees for the other copy methods and for max_per_source and
+        max_bytes_per_sec, which apply per work dir.
+
+        Returns a DataFrame of patient_id, work_dir, path, method and bytes per file.
+        """
+        if pipeline_name not in self.pipelines:
+            raise ValueError(
+                "Trying to collect a pipeline that does not exist: {}".format(pipeline_name))
+        if self.dest_results_dir is None:
+            raise ValueError("Collecting results requires a dest_results_dir")
+
+        pipeline = self.pipelines[pipeline_name]
+        patient_to_run_name = dict((patient, pipeline.run_name(patient))
+                                   for patient in self.view(pipeline.config.keep))
+
+        def list_run_dirs(work_dir):
+            try:
+                return set(listdir(path.join(work_dir, WORK_DIR_RESULTS)))
+            except OSError:
+                return set()
+
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.biokepi_work_dirs)))
+        try:
+            work_dir_runs = list(executor.map(list_run_dirs, self.biokepi_work_dirs))
+        finally:
+            executor.shutdown()
+
+        trees = []
+        for patient, run_name in patient_to_run_name.items():
+            found = [work_dir for work_dir, run_dirs in zip(self.biokepi_work_dirs, work_dir_runs)
+                     if run_name in run_dirs]
+            if len(found) > 1:
+                raise ValueError("Found outputs of {} for patient {} in several work dirs: {}".
+                                 format(run_name, patient.id, found))
+            if found:
+                trees.append((patient.id, found[0],
+                              path.join(found[0], WORK_DIR_RESULTS, run_name),
+                              path.join(self.dest_results_dir, run_name)))
+        print("Collecting outputs of {} of {} patients".format(
+            len(trees), len(patient_to_run_name)))
 
-    def populate(self, must_contain, only_complete=True, cohort=None):
+        df = collect_trees(trees, max_workers=max_workers, max_per_source=max_per_source,
+                           max_bytes_per_sec=max_bytes_per_sec, hardlink=hardlink)
+        df = df.rename(columns={"key": "patient_id", "source": "work_dir"})
+        print("Copied {} bytes; {} of {} files were already up to date".format(
+            df.bytes.sum(), (df.method == "skipped").sum(), len(df)))
+        return df
+
+    def run_name_owners(self):
+        """
+        Map each run name of every registered pipeline's kept patients to a dict from
+        pipeline name to patient ID. Patients that a pipeline has no run name for are left
+        out.
+        """
+        owners = {}
+        for pipeline_name, pipeline in self.pipelines.items():
+            for patient in self.view(pipeline.config.keep):
+                try:
+                    run_name = pipeline.run_name(patient)
+                except ValueError:
+                    continue
+                owners.setdefault(run_name, {})[pipeline_name] = patient.id
+        return owners
+
+    def disk_usage(self, pipeline_name, max_workers=16):
+        """
+        Disk usage of everything in the work dirs other than their shared toolkit, caches,
+        reference genomes and results, attributed to the kept patient whose run name for
+        the pipeline it is named after (patient_id is None for anything else).
+
+        Each path is named after the longest run name, of any registered pipeline, that it
+        matches (see match_run_name), so paths of another pipeline's runs whose names start
+        with one of this pipeline's run names are not attributed to it.
+
+        Returns a DataFrame of work_dir, path, run_name, patient_id, bytes and mtime (the
+        newest in the path's tree); see work_dir_usage.
+        """
+        if pipeline_name not in self.pipelines:
+            raise ValueError(
+                "Trying to measure a pipeline that does not exist: {}".format(pipeline_name))
+
+        owners = self.run_name_owners()
+        df = work_dir_usage(self.biokepi_work_dirs, owners.keys(), self.id_delims,
+                            max_workers=max_workers)
+        df.insert(3, "patient_id", [
+            owners.get(run_name, {}).get(pipeline_name) for run_name in df.run_name])
+        return df
+
+    def gc(self, pipeline_name, dry_run=True, retain_days=7, retain=[],
+           complete_artifacts=["variants"], stall_hours=24, max_workers=16):
+        """
+        Delete a pipeline's intermediates from the work dirs (see disk_usage) for patients
+        whose runs are finished: their results dir, in <work dir>/results, a results dir
+        or dest_results_dir, has every one of complete_artifacts (see ARTIFACT_TYPES), and,
+        as for a running pipeline in status, none of their launch, intermediates or
+        results is newer than stall_hours.
+
+        Intermediates modified in the last retain_days, or whose names match any of the
+        retain glob patterns, are kept. Nothing is deleted if dry_run is True.
+
+        Returns a DataFrame, by work dir, of total_bytes (everything measured),
+        patient_bytes (the pipeline's patients' intermediates), reclaimable_bytes and
+        reclaimed_bytes.
+        """
+        usage = self.disk_usage(pipeline_name, max_workers=max_workers)
+
+        results_dirs = self.run_results_dirs()
+        launch_times = self.run_history().last_launched(pipeline_name)
+
+        def scan_results(run_name):
+            # Whether any of the run's results dirs is complete, and their newest mtime.
+            is_complete = False
+            mtimes = []
+            for results_dir in results_dirs:
+                run_path = path.join(results_dir, run_name)
+                if path.isdir(run_path):
+                    listing = ResultsListing(run_path)
+                    if all(listing.artifacts[artifact] for artifact in complete_artifacts):
+                        is_complete = True
+                    mtimes.extend(mtime for (_, _, mtime) in listing.files)
+            return is_complete, max(mtimes) if mtimes else None
+
+        # Only this pipeline's runs; other paths may belong to other pipelines' runs.
+        run_names = sorted(set(usage.run_name[usage.patient_id.notnull()]))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            run_name_results = dict(zip(run_names, executor.map(scan_results, run_names)))
+            now = time.time()
+            last_activity = dict((run_name, results_mtime or 0)
+                                 for run_name, (_, results_mtime) in run_name_results.items())
+            for run_name, patient_id, mtime in zip(usage.run_name, usage.patient_id, usage.mtime):
+                if run_name in last_activity:
+                    for activity in [mtime, launch_times.get(str(patient_id))]:
+                        if pd.notnull(activity):
+                            last_activity[run_name] = max(last_activity[run_name], activity)
+            run_name_finished = dict(
+                (run_name, is_complete and now - last_activity[run_name] >= stall_hours * 60 * 60)
+                for run_name, (is_complete, _) in run_name_results.items())
+            usage["complete"] = usage.run_name.map(run_name_finished).fillna(False).astype(bool)
+            usage["retained"] = [
+                mtime is None or now - mtime < retain_days * 24 * 60 * 60 or
+                any(fnmatch(path.basename(usage_path), pattern) for pattern in retain)
+                for usage_path, mtime in zip(usage.path, usage.mtime)]
+            to_delete = usage[usage.complete & ~usage.retained]
+            if dry_run:
+                deleted = [False] * len(to_delete)
+            else:
+                deleted = list(executor.map(remove_path, to_delete.path))
+        finally:
+            executor.shutdown()
+
+        usage["reclaimable"] = usage.index.isin(to_delete.index)
+        usage["deleted"] = usage.index.isin(to_delete.index[deleted])
+        report = pd.DataFrame({
+            "total_bytes": usage.groupby("work_dir").bytes.sum(),
+            "patient_bytes": usage[usage.patient_id.notnull()].groupby("work_dir").bytes.sum(),
+            "reclaimable_bytes": usage[usage.reclaimable].groupby("work_dir").bytes.sum(),
+            "reclaimed_bytes": usage[usage.deleted].groupby("work_dir").bytes.sum(),
+        }, columns=["total_bytes", "patient_bytes", "reclaimable_bytes", "reclaimed_bytes"])
+        report = report.reindex(self.biokepi_work_dirs).fillna(0).astype("int64")
+        report.index.name = "work_dir"
+        print("{} {} bytes of intermediates from {} patients".format(
+            "Would reclaim" if dry_run else "Reclaimed",
+            report.reclaimable_bytes.sum() if dry_run else report.reclaimed_bytes.sum(),
+            to_delete.patient_id.nunique()))
+        return report
+
+    def verify_results(self, max_workers=None):
+        """
+        Checksum every file in biokepi_results_dirs and dest_results_dir (if given) on a
+        process pool, against a manifest stored in cache_dir, so that only new or changed
+        files are read again; see verify_trees.
+
+        Returns verify_trees's DataFrame: rows whose mismatch is True are files whose
+        copies (e.g. in a results dir and in dest_results_dir) differ.
+        """
+        roots = list(self.biokepi_results_dirs)
+        if self.dest_results_dir is not None:
+            roots.append(self.dest_results_dir)
+        manifest = Manifest(path.join(self.cache_dir, "manifest.sqlite"))
+        df = verify_trees(roots, manifest, max_workers=max_workers)
+        print("Verified {} files ({} hashed); {} differ between copies and {} are missing".format(
+            (df.status != "missing").sum(), df.status.isin(["new", "changed"]).sum(),
+            df.mismatch.sum(),
+            (df.status == "missing").sum()))
+        return df
+
+    def results_index(self):
+        """
+        The on-disk ResultsIndex of biokepi_results_dirs, stored in cache_dir.
+        """
+        if self._results_index is None:
+            self._results_index = ResultsIndex(path.join(self.cache_dir, "results_index.sqlite"))
+        return self._results_index
+
+    def run_history(self):
+        """
+        The on-disk RunHistory of pipeline launches, stored in cache_dir.
+        """
+        if self._run_history is None:
+            self._run_history = RunHistory(path.join(self.cache_dir, "history.sqlite"))
+        return self._run_history
+
+    def run_durations(self, pipeline_name=None):
+        """
+        By work dir: p50 and p95 launch latency and launch-to-completion duration (of
+        pipeline_name, or every pipeline). Completions are recorded by status.
+        """
+        return self.run_history().duration_stats(pipeline_name)
+
+    def slowest_patients(self, pipeline_name=None, n=10):
+        """
+        The n launches (of pipeline_name, or every pipeline) that took longest to complete.
+        """
+        return self.run_history().slowest(pipeline_name, n=n)
+
+    def throughput(self, pipeline_name=None, freq="1h"):
+        """
+        Launches and completions (of pipeline_name, or every pipeline) per period of freq.
+        """
+        return self.run_history().throughput(pipeline_name, freq=freq)
+
+    def populate_cache(self):
+        """
+        The on-disk ResultCache of populate results, stored in cache_dir.
+        """
+        if self._populate_cache is None:
+            self._populate_cache = ResultCache(path.join(self.cache_dir, "populate"))
+        return self._populate_cache
+
+    def refresh_results_index(self):
+        """
+        Bring the ResultsIndex up to date, only listing directories that changed. Results
+        dirs are refreshed concurrently.
+        """
+        results_index = self.results_index()
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.biokepi_results_dirs)))
+        try:
+            num_listed = sum(executor.map(results_index.refresh, self.biokepi_results_dirs))
+        finally:
+            executor.shutdown()
+        self._results_index_refreshed = True
+        logger.info("Refreshed the results index, listing {} changed dirs".format(num_listed))
+
+    def result_path(self, patient, artifact, refresh=False):
+        """
+        Look up a patient's result file from the ResultsIndex, where artifact is a file name
+        pattern (e.g. "*_result.tsv"). Returns None if there is no such file, and raises an
+        error if there are several.
+
+        The index is refreshed on first use, or if refresh is True.
+        """
+        if refresh or not self._results_index_refreshed:
+            self.refresh_results_index()
+
+        found = []
+        for patient_path in self.find_patient_dirs(patient, use_index=True):
+            found.extend(
+                file_path for (file_path, _, _) in self.results_index().find_files(
+                    patient_path, pattern=artifact))
+        if len(found) > 1:
+            raise ValueError("Found multiple {} results for patient {}: {}".format(
+                artifact, patient.id, found))
+        return found[0] if found else None
+
+    def find_patient_dirs(self, patient, use_index=False):
+        """
+        All of a patient's directories across the results dirs.
+        """
+        patient_index = self.patient_index()
+        patient_dirs = []
+        for results_dir in self.biokepi_results_dirs:
+            names = (self.results_index().list_dirs(results_dir) if use_index
+                     else sorted(listdir(results_dir)))
+            patient_dirs.extend(path.join(results_dir, name) for name in names
+                                if patient_index.find(name) is patient)
+        return patient_dirs
+
+    def find_patient_paths(self, must_contain=None, patients=None, use_index=False):
+        """
+        Map each patient to its directory in the results dirs, among directories whose
+        names contain must_contain (e.g. "dna"), if given.
+
+        Results dirs are listed concurrently, one task per results dir, so scanning many
+        NFS servers takes as long as the slowest one. If use_index is True, they are
+        listed from the ResultsIndex instead.
+        """
+        patient_index = self.patient_index(patients)
+
+        results_index = self.results_index() if use_index else None
+
+        def scan_results_dir(results_dir):
+            return list(scan_patient_dirs(results_dir, patient_index, must_contain=must_contain,
+                                          results_index=results_index))
+
+        # We may have different results directories on different NFS servers, for example.
+        # e.g. ['/nfs-pool-2/biokepi/results', '/nfs-pool-3/biokepi/results']
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.biokepi_results_dirs)))
+        try:
+            scanned = list(executor.map(scan_results_dir, self.biokepi_results_dirs))
+        finally:
+            executor.shutdown()
+
+        # Merge in results dir order, so that duplicate detection is deterministic.
+        patient_to_path = {}
+        for found in scanned:
+            for found_patient, patient_path in found:
+                add_patient_path(patient_to_path, found_patient, patient_path)
+        return patient_to_path
+
+    def populate(self, must_contain=None, only_complete=True, cohort=None, keep=None,
+                 use_index=False, hla_parser="native", use_cache=True, executor="thread",
+                 max_workers=16, populators=["optitype"], single_pass=None, lazy=False,
+                 progress=True):
         """
         must_contain determines what we're populating: RNA, DNA, etc.
         e.g. must_contain="dna" looks for "dna" in the root directory.
 
-        TODO: This does not yet work with Epidisco, where DNA and RNA are in the same root
-        directory.
+        With Epidisco, where DNA and RNA are in the same root directory, leave must_contain
+        as None and populate everything from each patient's single directory.
+
+        If use_index is True, refresh the ResultsIndex and find results from it rather than
+        by walking the results dirs.
+
+        hla_parser is "native" (read OptiType's output in-process) or "hlarp".
+
+        If use_cache is True, parsed results are cached in cache_dir, keyed by the size and
+        mtime of the files they were parsed from, and only changed outputs are re-parsed.
+
+        Patients are populated on a pool of max_workers threads, or processes if executor
+        is "process"; see populate_fn.
+
+        populators are the names of what to populate; see get_populator.
+
+        If single_pass is True, each patient's directory is walked once (see
+        ResultsListing) and every populator is fed from that walk. By default, this
+        happens when there are several populators and use_index is False.
+
+        keep (an f(patient) function or a PatientFilter) restricts population to
+        a PatientView of the matching patients, if no cohort is given.
 
         If only_complete is True, raise an error if we don't populate every Patient
         in the Cohort.
+
+        If lazy is True, only find each patient's results dir: each populated attribute
+        (e.g. patient.hla_alleles) is loaded on first access, or by materialize. only_complete
+        then only checks that every patient has a results dir.
+
+        If progress is True, report load throughput and ETA, overall and per results dir;
+        see Progress.
+        """
+        if cohort is None:
+            cohort = self.cohort if keep is None else self.view(keep)
+
+        results_index = None
+        if use_index:
+            self.refresh_results_index()
+            results_index = self.results_index()
+        patient_to_path = self.find_patient_paths(
+            must_contain=must_contain, patients=cohort, use_index=use_index)
+
+        # Here we list out different components to populate.
+        fns = [self.get_populator(populator_name, results_index=results_index,
+                                  hla_parser=hla_parser, use_cache=use_cache)
+               for populator_name in populators]
+        if lazy:
+            if only_complete and len(patient_to_path) < len(cohort):
+                raise ValueError(
+                    "Must populate entire Cohort ({} patients), but results were only found for {} patients".
+                    format(len(cohort), len(patient_to_path)))
+            for patient in cohort:
+                if patient in patient_to_path:
+                    for fn in fns:
+                        set_lazy(patient, fn.attr, fn.load, patient_to_path[patient])
+            return
+
+        if single_pass is None:
+            single_pass = len(fns) > 1 and not use_index
+        reporter = Progress(
+            len(patient_to_path) * (1 if single_pass else len(fns)), name="populate",
+            unit="patients" if single_pass or len(fns) == 1 else "loads",
+            pools=[path.normpath(results_dir) for results_dir in self.biokepi_results_dirs],
+            show=progress)
+        self.populate_fns(fns, patient_to_path=patient_to_path, only_complete=only_complete,
+                          cohort=cohort, executor=executor, max_workers=max_workers,
+                          single_pass=single_pass, progress=reporter)
+        if use_cache:
+            self.populate_cache().evict()
+
+    def iter_populate(self, must_contain=None, cohort=None, keep=None, use_index=False,
+                      hla_parser="native", use_cache=True, max_workers=16,
+                      populators=["optitype"], queue_size=64, apply=True):
+        """
+        Like populate, but yield (patient, results) as soon as each patient's results are
+        loaded, where results is a dict from populator name to value (None if there was no
+        valid data).
+
+        Scanning the results dirs, loading results and the caller's own work all happen
+        concurrently, through queues of at most queue_size patients, so memory use doesn't
+        grow with the Cohort. If apply is True, each patient is also updated (e.g. with
+        patient.hla_alleles) before it is yielded.
+
+        If use_index is True, refresh the ResultsIndex and find results from it rather than
+        by walking the results dirs.
+        """
+        if cohort is None:
+            cohort = self.cohort if keep is None else self.view(keep)
+        results_index = None
+        if use_index:
+            self.refresh_results_index()
+            results_index = self.results_index()
+        fns = [self.get_populator(populator_name, results_index=results_index,
+                                  hla_parser=hla_parser, use_cache=use_cache)
+               for populator_name in populators]
+
+        for patient, values in stream_results(
+                self.biokepi_results_dirs, must_contain=must_contain,
+                patient_index=self.patient_index(cohort), patients=cohort,
+                loads=[fn.load for fn in fns], results_index=results_index,
+                max_workers=max_workers, queue_size=queue_size):
+            if apply:
+                for fn, value in zip(fns, values):
+                    patient_modifier = fn.modifier(patient, value)
+                    if patient_modifier is not None:
+                        patient_modifier()
+            yield patient, dict(zip(populators, values))
+
+    def watch(self, populators=["optitype"], must_contain=None, on_populated=None,
+              existing=True, poll_secs=30, settle_secs=10, use_inotify=True,
+              hla_parser="native", use_cache=True, max_workers=16, max_polls=None):
+        """
+        Keep populating patients as their results land, until interrupted (or after
+        max_polls polls).
+
+        Each poll refreshes the ResultsIndex, so only changed directories are listed, and
+        finds patient dirs with the PatientIndex, as populate(use_index=True) does. A
+        patient is loaded once nothing in its dir has changed for settle_secs, and only
+        updated if every populator found valid data; otherwise it's retried after its dir
+        changes again. If existing is False, patients whose dirs are there on the first
+        poll are skipped until they change.
+
+        Polls happen every poll_secs, or sooner when inotify (see ChangeWaiter) sees a
+        change in a results dir or patient dir.
+
+        on_populated, if given, is called with the list of patients updated by each poll,
+        e.g. to launch a downstream pipeline with run_pipeline(only_changed=True).
+
+        Returns the number of patient updates.
+        """
+        results_index = self.results_index()
+        fns = [self.get_populator(populator_name, results_index=results_index,
+                                  hla_parser=hla_parser, use_cache=use_cache)
+               for populator_name in populators]
+
+        def load(patient_path):
+            try:
+                return [fn.load(patient_path) for fn in fns]
+            except Exception as e:
+                # e.g. a result file that's still being written.
+                logger.warning("Failed to load {}: {}".format(patient_path, repr(e)))
+                return None
+
+        waiter = ChangeWaiter(use_inotify=use_inotify)
+        waiter.watch(self.biokepi_results_dirs)
+        last_mtimes = {}
+        changed_at = {}
+        num_polls = 0
+        num_populated = 0
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            while max_polls is None or num_polls < max_polls:
+                num_polls += 1
+                self.refresh_results_index()
+                patient_to_path = self.find_patient_paths(must_contain=must_contain,
+                                                          use_index=True)
+                waiter.watch(patient_to_path.values())
+
+                now = time.time()
+                for patient, patient_path in patient_to_path.items():
+                    mtime = results_index.newest_mtime(patient_path)
+                    if patient in last_mtimes and last_mtimes[patient] == mtime:
+                        continue
+                    last_mtimes[patient] = mtime
+                    if existing or num_polls > 1:
+                        changed_at[patient] = now
+
+                ready = [patient for patient in self.cohort
+                         if patient in changed_at and now - changed_at[patient] >= settle_secs]
+                values = list(executor.map(
+                    load, [patient_to_path[patient] for patient in ready]))
+                populated = []
+                for patient, patient_values in zip(ready, values):
+                    del changed_at[patient]
+                    if patient_values is None or any(value is None for value in patient_values):
+                        continue
+                    for fn, value in zip(fns, patient_values):
+                        fn.modifier(patient, value)()
+                    populated.append(patient)
+                if populated:
+                    num_populated += len(populated)
+                    print("Populated {} patients: {}".format(
+                        len(populated), ", ".join(str(patient.id) for patient in populated)))
+                    if on_populated is not None:
+                        on_populated(populated)
+
+                if max_polls is not None and num_polls >= max_polls:
+                    break
+                # Wake up in time for the next patient to settle.
+                timeout_secs = poll_secs
+                if changed_at:
+                    timeout_secs = min(timeout_secs, max(
+                        0, min(changed_at.values()) + settle_secs - time.time()))
+                waiter.wait(timeout_secs)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            executor.shutdown()
+            waiter.close()
+        return num_populated
+
+    def materialize(self, cohort=None, executor="thread", max_workers=16):
+        """
+        Load every attribute left pending by populate(lazy=True), on a pool of max_workers
+        threads (or processes, if executor is "process").
         """
         if cohort is None:
             cohort = self.cohort
+        pending = [(patient, attr, load, patient_path)
+                   for patient in cohort
+                   for attr, (load, patient_path) in sorted(pending_attrs(patient).items())]
 
-        # We may have different results directories on different NFS servers, for example.
-        # e.g. ['/nfs-pool-2/biokepi/results', '/nfs-pool-3/biokepi/results']
-        patient_to_path = {}
-        new_patients = []
-        for results_dir in self.biokepi_results_dirs:
-            # e.g. '/nfs-pool-2/biokepi/results/lung-322'
-            for patient_dir in listdir(results_dir):
-                # Only look for e.g. "rna" or "dna" at a time.
-                if must_contain not in patient_dir:
-                    continue
+        pool = (ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor)(
+            max_workers=max_workers)
+        try:
+            futures = [pool.submit(load, patient_path) for (_, _, load, patient_path) in pending]
+            values = [future.result() for future in futures]
+        finally:
+            pool.shutdown()
 
-                # Look for a patient ID in the directory name.
-                found_patient = find_patient(self.cohort, patient_dir, self.id_delims)
-                if found_patient is not None:
-                    # Make sure we don't have multiple dirs per patient, either across or within the
-                    # root results directories, or e.g. RNA vs. DNA.
-                    patient_path = path.join(results_dir, patient_dir)
-                    if found_patient in patient_to_path:
-                        raise ValueError(
-                            "Already have a dir for patient {} ({}), but found another dir ({})".
-                            format(found_patient.id, patient_path, patient_to_path[found_patient]))
-                    else:
-                        patient_to_path[found_patient] = patient_path
+        for (patient, attr, _, _), value in zip(pending, values):
+            set_loaded(patient, attr, value)
 
-        # Here we list out different components to populate.
-        self.populate_fn(fn=populate_optitype, patient_to_path=patient_to_path, only_complete=only_complete, cohort=cohort)
+    def get_populator(self, populator_name, results_index=None, hla_parser="native",
+                      use_cache=True):
+        """
+        Build a Populator by name:
+
+        - "optitype": patient.hla_alleles, from OptiType
+        - "variants": patient.variant_table, a VariantTable of the patient's VCFs, stored
+          as memory-mappable columns in cache_dir
+        - "kallisto": patient.kallisto_abundance, the path to the patient's Kallisto
+          abundance.tsv; see expression_matrix
+        - "optitype_normal", "optitype_tumor", "optitype_rna" and "seq2hla":
+          patient.hla_alleles_<name>, from each of Epidisco's HLA callers; see hla_table
+        """
+        cache = self.populate_cache() if use_cache else None
+        if populator_name == "optitype":
+            return Populator(
+                load=partial(load_optitype, results_index=results_index, parser=hla_parser,
+                             cache=cache),
+                attr="hla_alleles")
+        if populator_name.startswith("optitype_"):
+            sample = populator_name.split("optitype_")[1]
+            if sample not in OPTITYPE_SAMPLES:
+                raise ValueError("Invalid OptiType sample: {}".format(sample))
+            return Populator(
+                load=partial(load_optitype, results_index=results_index, parser=hla_parser,
+                             cache=cache, sample=sample),
+                attr=hla_attr(populator_name))
+        if populator_name == "seq2hla":
+            return Populator(
+                load=partial(load_seq2hla, results_index=results_index, cache=cache),
+                attr=hla_attr(populator_name))
+        if populator_name == "variants":
+            return Populator(
+                load=partial(load_variants, cache_dir=path.join(self.cache_dir, "variants"),
+                             results_index=results_index),
+                attr="variant_table")
+        if populator_name == "kallisto":
+            return Populator(
+                load=partial(find_kallisto_abundance, results_index=results_index),
+                attr="kallisto_abundance")
+        raise ValueError("Invalid populator: {}".format(populator_name))
+
+    def hla_table(self, cohort=None, callers=HLA_CALLERS):
+        """
+        One table of each patient's HLA calls per caller (populated with the caller's
+        populator, e.g. "seq2hla"), plus their consensus; see hla.hla_consensus.
+        """
+        return hla_consensus(hla_calls(self.cohort if cohort is None else cohort, callers=callers))
 
-    def populate_fn(self, fn, patient_to_path, only_complete, cohort):
+    def expression_matrix(self, cohort=None, value="tpm", max_workers=16):
+        """
+        The transcript x patient float32 ExpressionMatrix of a Kallisto value (e.g. "tpm")
+        across the patients populated with "kallisto". It's built once and stored in
+        cache_dir, and then memory-mapped.
+        """
+        if cohort is None:
+            cohort = self.cohort
+        patient_to_abundance = {}
+        for patient in cohort:
+            abundance_path = getattr(patient, "kallisto_abundance", None)
+            if abundance_path is not None:
+                patient_to_abundance[patient.id] = abundance_path
+        return build_expression_matrix(
+            patient_to_abundance, cache_dir=path.join(self.cache_dir, "expression"),
+            value=value, max_workers=max_workers)
+
+    def variants_dataframe(self, cohort=None):
+        """
+        One DataFrame of the variants of every patient populated with "variants", read
+        from their memory-mapped VariantTables.
+        """
+        return concat_variant_tables(self.cohort if cohort is None else cohort)
+
+    def populate_fn(self, fn, patient_to_path, only_complete, cohort, executor="thread",
+                    max_workers=16):
         """
         For a given fn (e.g. populate_optitype) and patient paths (patient_to_path), update the
         patients (e.g. with patient.hla_alleles) in the cohort.
 
+        fn is called for each patient on a pool of max_workers threads, or processes if
+        executor is "process". Processes require a Populator, whose load step is sent to the
+        workers. Either way, patients are only updated on the calling thread.
+
         If only_complete is True, only update the patients if they will *all* be updated.
         """
-        patient_modifiers = []
-        for patient in cohort:
-            if patient not in patient_to_path:
-                continue
+        self.populate_fns([fn], patient_to_path=patient_to_path, only_complete=only_complete,
+                          cohort=cohort, executor=executor, max_workers=max_workers)
 
-            patient_path = patient_to_path[patient]
+    def populate_fns(self, fns, patient_to_path, only_complete, cohort, executor="thread",
+                     max_workers=16, single_pass=False, progress=None):
+        """
+        Like populate_fn, for several fns at once: every (fn, patient) pair runs in the
+        same pool, and nothing is updated unless every fn passes the only_complete check.
+
+        If single_pass is True, fns must be Populators, and there is one task per patient
+        that walks the patient's directory once and runs every load step on that walk.
+
+        progress, a Progress, is updated as each task finishes, with the patient's results
+        dir as its pool.
+        """
+        patients = [patient for patient in cohort if patient in patient_to_path]
+        if executor not in ["thread", "process"]:
+            raise ValueError("Invalid executor: {}".format(executor))
+        if executor == "process" or single_pass:
+            for fn in fns:
+                if not isinstance(fn, Populator):
+                    raise ValueError(
+                        "Populating with processes or in a single pass requires a Populator, "
+                        "but got {}".format(fn))
+
+        pool = (ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor)(
+            max_workers=max_workers)
+        def submit(patient, fn, *args):
+            future = pool.submit(fn, *args)
+            if progress is not None:
+                results_dir = path.dirname(patient_to_path[patient])
+                future.add_done_callback(lambda _: progress.update(pool=results_dir))
+            return future
+
+        try:
             # A patient modifier updates the patient as appropriate, when called.
             # e.g. patient.hla_alleles = hla_alleles
-            patient_modifier = fn(patient, patient_path)
-            if patient_modifier is not None:
-                patient_modifiers.append(patient_modifier)
+            if single_pass:
+                loads = [fn.load for fn in fns]
+                patient_futures = [submit(patient, load_single_pass, loads, patient_to_path[patient])
+                                   for patient in patients]
+                values = [future.result() for future in patient_futures]
+                results = [[fn.modifier(patient, patient_values[i])
+                            for patient, patient_values in zip(patients, values)]
+                           for i, fn in enumerate(fns)]
+            elif executor == "thread":
+                futures = [[submit(patient, fn, patient, patient_to_path[patient])
+                            for patient in patients] for fn in fns]
+                results = [[future.result() for future in fn_futures] for fn_futures in futures]
+            else:
+                futures = [[submit(patient, fn.load, patient_to_path[patient])
+                            for patient in patients] for fn in fns]
+                results = [[fn.modifier(patient, future.result())
+                            for patient, future in zip(patients, fn_futures)]
+                           for fn, fn_futures in zip(fns, futures)]
+        finally:
+            pool.shutdown()
+            if progress is not None:
+                progress.close()
 
-        if only_complete and len(patient_modifiers) < len(cohort):
-            raise ValueError(
-                "Must populate entire Cohort ({} patients), but valid data was only found for {} patients"
-            )
+        fn_modifiers = [[result for result in fn_results if result is not None]
+                        for fn_results in results]
 
-        for patient_modifier in patient_modifiers:
-            patient_modifier()
+        for patient_modifiers in fn_modifiers:
+            if only_complete and len(patient_modifiers) < len(cohort):
+                raise ValueError(
+                    "Must populate entire Cohort ({} patients), but valid data was only found for {} patients".
+                    format(len(cohort), len(patient_modifiers))
+                )
 
+        for patient_modifiers in fn_modifiers:
+            for patient_modifier in patient_modifiers:
+                patient_modifier()
 
-def get_hla_dirs(patient_path, caller):
-    if caller == "optitype":
-        tsv_files = find_files_recursive(search_path=patient_path, pattern="*.tsv")
-        tsv_dirs = [path.dirname(tsv_file) for tsv_file in tsv_files]
 
-        # Filter to those paths with the caller in the name
-        optitype_tsv_dirs = [tsv_dir for tsv_dir in tsv_dirs if "optitype" in tsv_dir.lower()]
+def load_single_pass(loads, patient_path):
+    """
+    Walk patient_path once, and run each Populator load step on that walk.
+    """
+    listing = ResultsListing(patient_path)
+    return [load(patient_path, results_index=listing) for load in loads]
+
+
+class Populator(object):
+    def __init__(self, load, attr):
+        """
+        A populate_fn populator split into two steps: load(patient_path), which returns
+        a value (or None if there isn't valid data) and can run in another process, and
+        setting patient.<attr> to that value.
+        """
+        self.load = load
+        self.attr = attr
+
+    def modifier(self, patient, value):
+        if value is None:
+            return None
+        return partial(setattr, patient, self.attr, value)
 
-        return optitype_tsv_dirs
-    raise ValueError("Invalid caller: {}".format(caller))
+    def __call__(self, patient, patient_path):
+        return self.modifier(patient, self.load(patient_path))
 
 
-def populate_optitype(patient, patient_path):
+def sweep_run_name(sweep_name, config):
     """
-    Given a path to a Patient's results, return a function f() that updates
-    the Patient's HLA alleles.
+    Run name function for a sweep grid point: identical rendered keyword arguments
+    give identical run names.
     """
-    caller = "optitype"
-    hla_dirs = get_hla_dirs(patient_path=patient_path, caller=caller)
+    def run_name(patient):
+        keyword_args = " ".join(render_keyword_args(config, patient))
+        return "{}_{}_{}".format(
+            sweep_name, patient.id, hashlib.sha1(keyword_args.encode("utf-8")).hexdigest()[:8])
+    return run_name
+
+
+def get_hla_dirs(patient_path, caller, max_dirs=None, results_index=None, sample=None):
+    """
+    Find the directories of a caller's HLA results under patient_path, first in the known
+    biokepi/Epidisco output locations and then by walking the whole tree (or from the
+    ResultsIndex, if given).
+
+    sample (e.g. "normal", "tumor" or "rna") restricts results to directories with it
+    as a whole word (delimited by anything but letters and digits) below patient_path,
+    e.g. optitype-rna but not internal. The whole tree is only walked if no known
+    location has results for the sample.
+
+    Stops looking once more than max_dirs directories are found, if given.
+    """
+    if caller not in HLA_RESULT_PATTERNS:
+        raise ValueError("Invalid caller: {}".format(caller))
+
+    def is_hla_result(result_file):
+        # Only paths with the caller in the name, and the sample, if given.
+        result_dir = path.dirname(result_file)
+        if caller not in result_dir.lower():
+            return False
+        return sample is None or sample in re.split(
+            r"[^a-z0-9]+", path.relpath(result_dir, patient_path).lower())
+
+    pattern = HLA_RESULT_PATTERNS[caller]
+    if results_index is not None:
+        result_files = [file_path for (file_path, _, _) in results_index.find_files(
+            patient_path, pattern=pattern) if is_hla_result(file_path)]
+    else:
+        result_files = [file_path for file_path in find_files_known_layouts(
+            search_path=patient_path,
+            layouts=[layout.format(caller=caller, pattern=pattern) for layout in HLA_LAYOUTS])
+            if is_hla_result(file_path)]
+        if not result_files:
+            result_files = (entry.path for entry in scan_tree(
+                search_path=patient_path, pattern=pattern, prune=RESULTS_PRUNE_PATTERNS)
+                if is_hla_result(entry.path))
+
+    hla_dirs = []
+    for result_file in result_files:
+        result_dir = path.dirname(result_file)
+        if result_dir in hla_dirs:
+            continue
+        hla_dirs.append(result_dir)
+        if max_dirs is not None and len(hla_dirs) > max_dirs:
+            break
+
+    return hla_dirs
+
+
+def get_hla_dir(patient_path, caller, results_index=None, sample=None):
+    """
+    The single directory of a caller's HLA results under patient_path, or None (with a
+    warning) if there isn't exactly one.
+    """
+    hla_dirs = get_hla_dirs(patient_path=patient_path, caller=caller, max_dirs=1,
+                            results_index=results_index, sample=sample)
     if len(hla_dirs) > 1:
         logger.warning(("More than one dir found for HLA results in {}, "
                         "but only one expected").format(patient_path))
@@ -183,11 +1257,78 @@ def populate_optitype(patient, patient_path):
         logger.warning("No HLA dirs found in {}".format(patient_path))
         return None
 
-    hla_dir = hla_dirs[0]
-    df_hlarp = run_hlarp(results_dir=hla_dir, caller=caller)
-    hla_alleles = list(df_hlarp.allele)
+    return hla_dirs[0]
+
+
+def load_optitype(patient_path, results_index=None, parser="native", cache=None, sample=None):
+    """
+    Given a path to a Patient's results, return the Patient's HLA alleles, or None
+    if there isn't exactly one dir of OptiType results.
+
+    parser is "native" (read OptiType's result TSV in-process) or "hlarp".
+
+    If a ResultCache is given, HLA alleles are only parsed if the OptiType
+    outputs changed since they were cached.
+
+    sample (e.g. "normal") selects OptiType results for one sample; see get_hla_dirs.
+    """
+    if parser not in ["native", "hlarp"]:
+        raise ValueError("Invalid HLA parser: {}".format(parser))
+
+    caller = "optitype"
+    hla_dir = get_hla_dir(
+        patient_path=patient_path, caller=caller, results_index=results_index, sample=sample)
+    if hla_dir is None:
+        return None
 
-    def modifier():
-        patient.hla_alleles = hla_alleles
+    hla_alleles = None
+    if cache is not None:
+        cache_key = cache.key(caller, parser, hla_dir, file_stats(hla_dir))
+        hla_alleles = cache.get(cache_key)
 
-    return modifier
+    if hla_alleles is None:
+        if parser == "native":
+            df_hla = read_optitype(hla_dir)
+        else:
+            df_hla = run_hlarp(results_dir=hla_dir, caller=caller)
+        hla_alleles = list(df_hla.allele)
+        if cache is not None:
+            cache.put(cache_key, hla_alleles)
+
+    return hla_alleles
+
+
+def load_seq2hla(patient_path, results_index=None, cache=None):
+    """
+    Given a path to a Patient's results, return the Patient's Seq2HLA class I alleles,
+    or None if there isn't exactly one dir of Seq2HLA results.
+    """
+    caller = "seq2hla"
+    hla_dir = get_hla_dir(patient_path=patient_path, caller=caller, results_index=results_index)
+    if hla_dir is None:
+        return None
+
+    hla_alleles = None
+    if cache is not None:
+        cache_key = cache.key(caller, hla_dir, file_stats(hla_dir))
+        hla_alleles = cache.get(cache_key)
+
+    if hla_alleles is None:
+        hla_alleles = list(read_seq2hla(hla_dir).allele)
+        if cache is not None:
+            cache.put(cache_key, hla_alleles)
+
+    return hla_alleles
+
+
+def populate_optitype(patient, patient_path, results_index=None, parser="native", cache=None):
+    """
+    Given a path to a Patient's results, return a function f() that updates
+    the Patient's HLA alleles.
+
+    See load_optitype for the arguments.
+    """
+    populator = Populator(
+        load=partial(load_optitype, results_index=results_index, parser=parser, cache=cache),
+        attr="hla_alleles")
+    return populator(patient, patient_path)
@@ -0,0 +1,144 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+from os import path, makedirs
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+from .parsers import read_kallisto_abundance
+from .utils import scan_tree, get_logger, atomic_write, RESULTS_PRUNE_PATTERNS
+
+logger = get_logger(__name__)
+
+
+def gencode_gene(target_id):
+    """
+    The gene ID of a GENCODE-style transcript ID, e.g. "ENST...|ENSG...|...".
+    """
+    fields = target_id.split("|")
+    if len(fields) < 2:
+        raise ValueError("Can't find a gene ID in transcript {}".format(target_id))
+    return fields[1]
+
+
+class ExpressionMatrix(object):
+    def __init__(self, matrix_dir):
+        """
+        A transcript x patient float32 expression matrix stored in matrix_dir as a
+        memory-mappable matrix.npy, with its transcripts and patient IDs in JSON.
+        """
+        self.matrix_dir = matrix_dir
+        with open(path.join(matrix_dir, "transcripts.json")) as f:
+            self.transcripts = json.load(f)
+        with open(path.join(matrix_dir, "patients.json")) as f:
+            self.patient_ids = json.load(f)
+
+    @property
+    def matrix(self):
+        return np.load(path.join(self.matrix_dir, "matrix.npy"), mmap_mode="r")
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.matrix, index=self.transcripts, columns=self.patient_ids)
+
+    def gene_level(self, transcript_to_gene=gencode_gene):
+        """
+        Sum transcripts into genes, where transcript_to_gene is a function or a dict.
+        """
+        if callable(transcript_to_gene):
+            genes = [transcript_to_gene(transcript) for transcript in self.transcripts]
+        else:
+            genes = [transcript_to_gene[transcript] for transcript in self.transcripts]
+        return self.to_dataframe().groupby(np.array(genes), sort=True).sum(min_count=1)
+
+    def __repr__(self):
+        return "ExpressionMatrix({} transcripts x {} patients)".format(
+            len(self.transcripts), len(self.patient_ids))
+
+
+def find_kallisto_abundance(patient_path, results_index=None):
+    """
+    Given a path to a Patient's results, return the path to its Kallisto abundance.tsv,
+    or None if there isn't exactly one.
+    """
+    if results_index is not None:
+        abundance_paths = [file_path for (file_path, _, _) in results_index.find_files(
+            patient_path, pattern="abundance.tsv")]
+    else:
+        abundance_paths = [entry.path for entry in scan_tree(
+            patient_path, pattern="abundance.tsv", prune=RESULTS_PRUNE_PATTERNS)]
+
+    if len(abundance_paths) > 1:
+        logger.warning("More than one Kallisto abundance.tsv found in {}, but only one expected".format(
+            patient_path))
+        return None
+    if len(abundance_paths) == 0:
+        logger.warning("No Kallisto abundance.tsv found in {}".format(patient_path))
+        return None
+    return abundance_paths[0]
+
+
+def build_expression_matrix(patient_to_abundance, cache_dir, value="tpm", max_workers=16):
+    """
+    Build (or load from cache_dir) the transcript x patient float32 matrix of a Kallisto
+    value across patient_to_abundance, a dict from patient ID to abundance.tsv path.
+
+    abundance.tsv files are read in parallel, and transcripts are aligned across patients;
+    transcripts a patient doesn't have are NaN.
+    """
+    patient_ids = sorted(patient_to_abundance.keys())
+    abundance_paths = [patient_to_abundance[patient_id] for patient_id in patient_ids]
+    key_parts = [value] + [[patient_id, abundance_path, path.getsize(abundance_path),
+                            path.getmtime(abundance_path)]
+                           for patient_id, abundance_path in zip(patient_ids, abundance_paths)]
+    key = hashlib.sha1(json.dumps(key_parts).encode("utf-8")).hexdigest()
+    matrix_dir = path.join(cache_dir, key)
+    if path.exists(matrix_dir):
+        return ExpressionMatrix(matrix_dir)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        abundances = list(executor.map(
+            lambda abundance_path: read_kallisto_abundance(abundance_path, value=value),
+            abundance_paths))
+    finally:
+        executor.shutdown()
+
+    # Kallisto runs against the same index usually report the same transcripts in the
+    # same order, in which case no alignment is needed.
+    transcripts = abundances[0].index if abundances else pd.Index([])
+    for abundance in abundances[1:]:
+        if not abundance.index.equals(transcripts):
+            transcripts = transcripts.union(abundance.index)
+    matrix = np.full((len(transcripts), len(patient_ids)), np.nan, dtype=np.float32)
+    for i, abundance in enumerate(abundances):
+        if abundance.index.equals(transcripts):
+            matrix[:, i] = abundance.values
+        else:
+            matrix[transcripts.get_indexer(abundance.index), i] = abundance.values
+
+    try:
+        makedirs(cache_dir)
+    except OSError:
+        # Already exists, possibly created by another worker.
+        pass
+    with atomic_write(matrix_dir, is_dir=True) as tmp_dir:
+        np.save(path.join(tmp_dir, "matrix.npy"), matrix)
+        with open(path.join(tmp_dir, "transcripts.json"), "w") as f:
+            json.dump(list(transcripts), f)
+        with open(path.join(tmp_dir, "patients.json"), "w") as f:
+            json.dump(patient_ids, f)
+    return ExpressionMatrix(matrix_dir)
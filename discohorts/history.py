@@ -0,0 +1,126 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pandas as pd
+
+from .store import SQLiteStore
+
+LAUNCH_COLUMNS = ["pipeline", "patient_id", "work_dir", "argv_hash", "input_bytes",
+                  "launched_at", "launch_secs", "exit_code", "completed_at"]
+
+
+class RunHistory(SQLiteStore):
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS launches "
+        "(pipeline TEXT, patient_id TEXT, work_dir TEXT, argv_hash TEXT, "
+        "input_bytes INTEGER, launched_at REAL, launch_secs REAL, exit_code INTEGER, "
+        "completed_at REAL)",
+        "CREATE INDEX IF NOT EXISTS launches_patient ON launches (pipeline, patient_id)",
+    ]
+
+    def __init__(self, db_path):
+        """
+        An on-disk (SQLite) history of pipeline launches: one row per launch, with its
+        work dir, a hash of its argv, the size of its inputs, when it was launched, how
+        long the launch command took, its exit code and, once known, when its results
+        were completed. Times are in seconds since the epoch.
+        """
+        SQLiteStore.__init__(self, db_path)
+
+    def record_launch(self, pipeline, patient_id, work_dir, argv_hash, input_bytes,
+                      launched_at, launch_secs, exit_code):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO launches VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                (pipeline, str(patient_id), work_dir, argv_hash, input_bytes, launched_at,
+                 launch_secs, exit_code))
+
+    def record_completion(self, pipeline, patient_id, completed_at):
+        """
+        Mark the patient's latest successful launch before completed_at as completed then,
+        if it isn't marked already.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE launches SET completed_at = ? WHERE rowid = ("
+                "SELECT rowid FROM launches WHERE pipeline = ? AND patient_id = ? "
+                "AND exit_code = 0 AND launched_at <= ? ORDER BY launched_at DESC LIMIT 1) "
+                "AND completed_at IS NULL",
+                (completed_at, pipeline, str(patient_id), completed_at))
+
+    def last_launched(self, pipeline):
+        """
+        Map from patient ID to the time of its latest successful launch of pipeline.
+        """
+        with self.lock:
+            return dict(self.connection.execute(
+                "SELECT patient_id, MAX(launched_at) FROM launches "
+                "WHERE pipeline = ? AND exit_code = 0 GROUP BY patient_id",
+                (pipeline,)).fetchall())
+
+    def launches(self, pipeline=None):
+        """
+        Every recorded launch (of pipeline, if given) as a DataFrame, with a duration_secs
+        column for completed launches.
+        """
+        with self.lock:
+            if pipeline is None:
+                rows = self.connection.execute("SELECT * FROM launches").fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT * FROM launches WHERE pipeline = ?", (pipeline,)).fetchall()
+        df = pd.DataFrame(rows, columns=LAUNCH_COLUMNS)
+        for column in ["launched_at", "launch_secs", "completed_at"]:
+            df[column] = df[column].astype(float)
+        df["duration_secs"] = df.completed_at - df.launched_at
+        return df
+
+    def duration_stats(self, pipeline=None):
+        """
+        By work dir: the number of launches and completions, and the p50 and p95 of
+        launch command latency and of launch-to-completion duration, in seconds.
+        """
+        df = self.launches(pipeline)
+        by_work_dir = df.groupby("work_dir")
+        stats = pd.DataFrame({
+            "launches": by_work_dir.size(),
+            "completed": by_work_dir.completed_at.count(),
+            "launch_p50": by_work_dir.launch_secs.quantile(0.5),
+            "launch_p95": by_work_dir.launch_secs.quantile(0.95),
+            "duration_p50": by_work_dir.duration_secs.quantile(0.5),
+            "duration_p95": by_work_dir.duration_secs.quantile(0.95),
+        }, columns=["launches", "completed", "launch_p50", "launch_p95", "duration_p50",
+                    "duration_p95"])
+        return stats
+
+    def slowest(self, pipeline=None, n=10):
+        """
+        The n completed launches that took longest from launch to completion.
+        """
+        df = self.launches(pipeline)
+        return df[df.duration_secs.notnull()].sort_values(
+            "duration_secs", ascending=False).head(n).reset_index(drop=True)
+
+    def throughput(self, pipeline=None, freq="1h"):
+        """
+        Launches and completions per period of freq (a pandas offset alias, e.g. "1h"
+        or "1D").
+        """
+        df = self.launches(pipeline)
+        launched = pd.Series(1, index=pd.to_datetime(df.launched_at, unit="s"))
+        completed = pd.Series(1, index=pd.to_datetime(df.completed_at.dropna(), unit="s"))
+        return pd.DataFrame({
+            "launched": launched.resample(freq).sum(),
+            "completed": completed.resample(freq).sum(),
+        }, columns=["launched", "completed"]).fillna(0).astype("int64")
@@ -0,0 +1,71 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pandas as pd
+
+# Every HLA caller Epidisco can run, and the Patient attribute each is populated into.
+HLA_CALLERS = ["optitype_normal", "optitype_tumor", "optitype_rna", "seq2hla"]
+
+
+def hla_attr(caller):
+    return "hla_alleles_{}".format(caller)
+
+
+def normalize_alleles(alleles):
+    """
+    Normalize a Series of alleles from different callers to e.g. "A*02:01", returning a
+    DataFrame of locus and allele (NaN where an allele can't be parsed).
+    """
+    parts = alleles.astype(str).str.extract(r"^(?:HLA-)?([A-Z0-9]+)\*(\d{2,3}):?(\d{2,3})")
+    return pd.DataFrame({
+        "locus": parts[0],
+        "allele": parts[0] + "*" + parts[1] + ":" + parts[2],
+    }, index=alleles.index)
+
+
+def hla_calls(patients, callers=HLA_CALLERS):
+    """
+    One DataFrame of patient_id, caller, locus and (normalized) allele, for every call
+    populated into each patient's hla_alleles_<caller>.
+    """
+    rows = [(patient.id, caller, allele)
+            for patient in patients
+            for caller in callers
+            for allele in (getattr(patient, hla_attr(caller), None) or [])]
+    df = pd.DataFrame(rows, columns=["patient_id", "caller", "raw_allele"])
+    df = pd.concat([df, normalize_alleles(df.raw_allele)], axis=1)
+    return df[["patient_id", "caller", "locus", "allele"]].dropna()
+
+
+def hla_consensus(df_calls):
+    """
+    Given hla_calls, return a table indexed by patient_id with each caller's alleles,
+    the number of callers with calls, and the consensus: per locus, the (up to two)
+    alleles called by a majority of the callers that made calls at that locus.
+    """
+    distinct_calls = df_calls.drop_duplicates(["patient_id", "caller", "allele"])
+    num_callers = distinct_calls.groupby(["patient_id", "locus"]).caller.nunique().rename(
+        "num_callers")
+    support = distinct_calls.groupby(["patient_id", "locus", "allele"]).caller.nunique().rename(
+        "support").reset_index().merge(num_callers.reset_index(), on=["patient_id", "locus"])
+    majority = support[support.support * 2 > support.num_callers].sort_values(
+        ["patient_id", "locus", "support", "allele"], ascending=[True, True, False, True])
+    majority = majority.groupby(["patient_id", "locus"]).head(2)
+
+    table = df_calls.groupby(["patient_id", "caller"]).allele.apply(list).unstack("caller")
+    table.columns.name = None
+    table["num_callers"] = df_calls.groupby("patient_id").caller.nunique()
+    table["consensus"] = majority.groupby("patient_id").allele.apply(sorted)
+    table["consensus"] = table.consensus.apply(lambda alleles: alleles if isinstance(alleles, list) else [])
+    return table
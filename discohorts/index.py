@@ -0,0 +1,211 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+from fnmatch import fnmatch
+from os import path, scandir, stat
+
+from .store import SQLiteStore
+from .utils import scan_tree, RESULTS_PRUNE_PATTERNS
+
+# Artifact types in biokepi/Epidisco results, as functions of a file's path relative to
+# the patient's results dir (lowercased).
+ARTIFACT_TYPES = [
+    ("rna_alignment", lambda rel_path: rel_path.endswith(".bam") and "rna" in rel_path),
+    ("dna_alignment", lambda rel_path: rel_path.endswith(".bam")),
+    ("hla", lambda rel_path: (
+        ("optitype" in rel_path and rel_path.endswith(".tsv")) or
+        rel_path.endswith(".hlagenotype4digits"))),
+    ("variants", lambda rel_path: rel_path.endswith(".vcf") or rel_path.endswith(".vcf.gz")),
+    ("expression", lambda rel_path: path.basename(rel_path) == "abundance.tsv"),
+]
+
+
+def under_range(dir_path):
+    """
+    Bounds (low, high) such that low <= p < high for exactly the paths p under dir_path.
+    SQLite can answer these comparisons from an index (which a pattern match can't, on a
+    case-sensitive column), so lookups under a dir stay fast as the index grows.
+    """
+    prefix = dir_path.rstrip(path.sep) + path.sep
+    return prefix, prefix[:-1] + chr(ord(path.sep) + 1)
+
+
+def classify_artifacts(patient_path, file_paths):
+    """
+    Dict from each of ARTIFACT_TYPES to the file_paths (under patient_path) of that type.
+    """
+    artifacts = dict((artifact_type, []) for artifact_type, _ in ARTIFACT_TYPES)
+    for file_path in file_paths:
+        rel_path = path.relpath(file_path, patient_path).lower()
+        for artifact_type, matches in ARTIFACT_TYPES:
+            if matches(rel_path):
+                artifacts[artifact_type].append(file_path)
+                break
+    return artifacts
+
+
+class ResultsIndex(SQLiteStore):
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)",
+        "CREATE TABLE IF NOT EXISTS files "
+        "(path TEXT PRIMARY KEY, dir TEXT, name TEXT, size INTEGER, mtime REAL)",
+        "CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)",
+        "CREATE INDEX IF NOT EXISTS files_dir ON files (dir)",
+    ]
+
+    def __init__(self, db_path):
+        """
+        An on-disk (SQLite) index of results trees: every directory with its mtime, and
+        every file with its size and mtime.
+
+        refresh only lists directories whose mtime changed since they were last indexed,
+        so files that are modified in place (rather than created, deleted or renamed)
+        are not picked up.
+        """
+        SQLiteStore.__init__(self, db_path)
+
+    def refresh(self, root):
+        """
+        Bring the index of root up to date, returning the number of directories listed.
+
+        root may be inside an already indexed tree (e.g. a single patient's dir): every
+        directory's parent is its actual parent dir, so the enclosing tree's listings
+        are unaffected. Directories matching RESULTS_PRUNE_PATTERNS are left out.
+        """
+        root = path.normpath(root)
+        num_listed = 0
+        stack = [root]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                dir_mtime = stat(dir_path).st_mtime
+            except OSError:
+                self.remove_dir(dir_path)
+                continue
+
+            indexed = self.query("SELECT mtime FROM dirs WHERE path = ?", (dir_path,))
+            if indexed and indexed[0][0] == dir_mtime:
+                # Nothing was added or removed here, but subdirectories may have changed.
+                stack.extend(sub_dir for (sub_dir, ) in self.query(
+                    "SELECT path FROM dirs WHERE parent = ?", (dir_path,)))
+                continue
+
+            num_listed += 1
+            files = []
+            sub_dirs = []
+            try:
+                for entry in scandir(dir_path):
+                    if entry.is_dir(follow_symlinks=False):
+                        if not any(fnmatch(entry.name, prune_pattern)
+                                   for prune_pattern in RESULTS_PRUNE_PATTERNS):
+                            sub_dirs.append(entry.path)
+                    else:
+                        try:
+                            entry_stat = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((entry.path, dir_path, entry.name, entry_stat.st_size,
+                                      entry_stat.st_mtime))
+            except OSError:
+                continue
+
+            indexed_sub_dirs = set(sub_dir for (sub_dir, ) in self.query(
+                "SELECT path FROM dirs WHERE parent = ?", (dir_path,)))
+            for removed_dir in indexed_sub_dirs - set(sub_dirs):
+                self.remove_dir(removed_dir)
+
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM files WHERE dir = ?", (dir_path,))
+                self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", files)
+                self.connection.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                        (dir_path, path.dirname(dir_path), dir_mtime))
+            stack.extend(sub_dirs)
+        return num_listed
+
+    def remove_dir(self, dir_path):
+        """
+        Remove a directory and everything under it from the index.
+        """
+        low, high = under_range(dir_path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+                (dir_path, low, high))
+            self.connection.execute(
+                "DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)",
+                (dir_path, low, high))
+
+    def list_dirs(self, dir_path):
+        """
+        Names of the indexed directories directly inside dir_path.
+        """
+        return sorted(path.basename(sub_dir) for (sub_dir, ) in self.query(
+            "SELECT path FROM dirs WHERE parent = ?", (path.normpath(dir_path),)))
+
+    def find_files(self, search_path, pattern="*"):
+        """
+        Indexed files under search_path whose names match pattern, as (path, size, mtime).
+        """
+        search_path = path.normpath(search_path)
+        rows = self.query(
+            "SELECT path, name, size, mtime FROM files "
+            "WHERE dir = ? OR (dir >= ? AND dir < ?) ORDER BY path",
+            (search_path, ) + under_range(search_path))
+        return [(file_path, size, mtime) for (file_path, name, size, mtime) in rows
+                if fnmatch(name, pattern) and (pattern.startswith(".") or not name.startswith("."))]
+
+    def newest_mtime(self, search_path):
+        """
+        The newest mtime of any indexed directory or file in search_path (itself included),
+        or None if nothing there is indexed.
+        """
+        search_path = path.normpath(search_path)
+        low, high = under_range(search_path)
+        mtimes = [mtime for (mtime, ) in self.query(
+            "SELECT MAX(mtime) FROM dirs WHERE path = ? OR (path >= ? AND path < ?) "
+            "UNION ALL SELECT MAX(mtime) FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)",
+            (search_path, low, high, search_path, low, high)) if mtime is not None]
+        return max(mtimes) if mtimes else None
+
+
+class ResultsListing(object):
+    def __init__(self, patient_path):
+        """
+        A single traversal of a patient's results dir, with every file classified into
+        ARTIFACT_TYPES (in artifacts, a dict from type to paths).
+
+        It answers find_files like a ResultsIndex, so that every populator can be fed from
+        the one traversal.
+        """
+        self.patient_path = path.normpath(patient_path)
+        self.files = []
+        for entry in scan_tree(self.patient_path, prune=RESULTS_PRUNE_PATTERNS):
+            if entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            self.files.append((entry.path, entry_stat.st_size, entry_stat.st_mtime))
+
+        self.artifacts = classify_artifacts(
+            self.patient_path, [file_path for file_path, _, _ in self.files])
+
+    def find_files(self, search_path, pattern="*"):
+        search_path = path.normpath(search_path)
+        return [(file_path, size, mtime) for (file_path, size, mtime) in self.files
+                if (file_path.startswith(search_path + path.sep) and
+                    fnmatch(path.basename(file_path), pattern))]
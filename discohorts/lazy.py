@@ -0,0 +1,105 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Lock, RLock
+from weakref import WeakKeyDictionary
+
+# Pending lazy attributes live in each patient's __dict__ under this key, as a dict from
+# attribute to (load, patient_path). The dict is replaced rather than changed in place,
+# since shallow copies of a patient share it.
+PENDING_KEY = "_discohorts_pending"
+
+_lazy_classes = set()
+_locks = WeakKeyDictionary()
+_locks_lock = Lock()
+
+
+def install_lazy_hooks(cls):
+    """
+    Let instances of cls (and its subclasses) load pending lazy attributes on first
+    access, by giving cls a __getattr__ that does so. Note that this changes cls (e.g.
+    cohorts' Patient) for the rest of the process, though instances without pending
+    attributes behave as before.
+
+    Patients keep their class, so type checks work as usual, and pending attributes are
+    pickled and copied as they are, without loading them. In another process, where
+    nothing may have installed the hook, resolve loads them explicitly.
+    """
+    with _locks_lock:
+        if any(base in _lazy_classes for base in cls.__mro__):
+            return
+        fallback_getattr = getattr(cls, "__getattr__", None)
+
+        def __getattr__(self, name):
+            # Only called when normal attribute lookup fails, i.e. for pending attributes.
+            if name in self.__dict__.get(PENDING_KEY, {}):
+                return resolve(self, name)
+            if fallback_getattr is not None:
+                return fallback_getattr(self, name)
+            raise AttributeError("'{}' object has no attribute '{}'".format(
+                type(self).__name__, name))
+
+        cls.__getattr__ = __getattr__
+        _lazy_classes.add(cls)
+
+
+def patient_lock(patient):
+    with _locks_lock:
+        if patient not in _locks:
+            _locks[patient] = RLock()
+        return _locks[patient]
+
+
+def set_lazy(patient, attr, load, patient_path):
+    """
+    Make patient.<attr> load(patient_path) on first access.
+    """
+    with patient_lock(patient):
+        pending = pending_attrs(patient)
+        pending[attr] = (load, patient_path)
+        patient.__dict__[PENDING_KEY] = pending
+        patient.__dict__.pop(attr, None)
+    install_lazy_hooks(type(patient))
+
+
+def pending_attrs(patient):
+    return dict(patient.__dict__.get(PENDING_KEY, {}))
+
+
+def set_loaded(patient, attr, value):
+    """
+    Set a pending attribute to its loaded value, unless another thread already did.
+    """
+    with patient_lock(patient):
+        pending = pending_attrs(patient)
+        if attr in pending:
+            del pending[attr]
+            patient.__dict__[attr] = value
+        if pending:
+            patient.__dict__[PENDING_KEY] = pending
+        else:
+            patient.__dict__.pop(PENDING_KEY, None)
+        return patient.__dict__[attr]
+
+
+def resolve(patient, attr):
+    """
+    Load a pending attribute. Loads of the same patient are serialized, so each
+    attribute is only loaded once.
+    """
+    with patient_lock(patient):
+        if attr in patient.__dict__:
+            return patient.__dict__[attr]
+        load, patient_path = patient.__dict__[PENDING_KEY][attr]
+        return set_loaded(patient, attr, load(patient_path))
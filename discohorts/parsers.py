@@ -0,0 +1,146 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from glob import glob
+from os import path
+import csv
+import gzip
+import pandas as pd
+
+OPTITYPE_ALLELE_COLUMNS = ["A1", "A2", "B1", "B2", "C1", "C2"]
+OPTITYPE_COLUMNS = ["sample", "allele", "reads", "objective"]
+
+
+def find_optitype_result(results_dir):
+    """
+    Find OptiType's <timestamp>_result.tsv in a results dir; if it was run more than
+    once, use the latest run.
+    """
+    result_files = sorted(glob(path.join(results_dir, "*_result.tsv")))
+    if not result_files:
+        result_files = sorted(glob(path.join(results_dir, "*.tsv")))
+    if not result_files:
+        return None
+    return result_files[-1]
+
+
+def parse_optitype_rows(result_file):
+    """
+    Yield (allele, reads, objective) for each allele call in an OptiType result TSV.
+    Homozygous calls are listed twice, as OptiType reports them.
+    """
+    with open(result_file) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            reads = float(row["Reads"]) if row.get("Reads") else None
+            objective = float(row["Objective"]) if row.get("Objective") else None
+            for column in OPTITYPE_ALLELE_COLUMNS:
+                allele = (row.get(column) or "").strip()
+                if allele:
+                    yield allele, reads, objective
+
+
+def read_optitype_batch(results_dirs):
+    """
+    Read the OptiType results in each of results_dirs into a single DataFrame of
+    sample (the results dir), allele, reads and objective, with one row per allele.
+    """
+    columns = dict((column, []) for column in OPTITYPE_COLUMNS)
+    for results_dir in results_dirs:
+        result_file = find_optitype_result(results_dir)
+        if result_file is None:
+            raise ValueError("No OptiType results found in {}".format(results_dir))
+        for allele, reads, objective in parse_optitype_rows(result_file):
+            columns["sample"].append(results_dir)
+            columns["allele"].append(allele)
+            columns["reads"].append(reads)
+            columns["objective"].append(objective)
+    return pd.DataFrame(columns, columns=OPTITYPE_COLUMNS)
+
+
+def read_optitype(results_dir):
+    """
+    Read one OptiType results dir; see read_optitype_batch.
+    """
+    return read_optitype_batch([results_dir])
+
+
+SEQ2HLA_COLUMNS = ["sample", "locus", "allele", "confidence"]
+
+
+def find_seq2hla_result(results_dir):
+    result_files = sorted(glob(path.join(results_dir, "*-ClassI.HLAgenotype4digits")))
+    if not result_files:
+        return None
+    return result_files[-1]
+
+
+def read_seq2hla(results_dir):
+    """
+    Read Seq2HLA's class I 4-digit genotype into a DataFrame of sample (the results dir),
+    locus, allele and confidence, with one row per allele. Seq2HLA's "'" suffix, which
+    marks a non-significant call, is removed.
+    """
+    result_file = find_seq2hla_result(results_dir)
+    if result_file is None:
+        raise ValueError("No Seq2HLA results found in {}".format(results_dir))
+
+    columns = dict((column, []) for column in SEQ2HLA_COLUMNS)
+    with open(result_file) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            locus = fields[0]
+            # Locus, Allele 1, Confidence, Allele 2, Confidence
+            for allele, confidence in zip(fields[1::2], fields[2::2]):
+                allele = allele.strip().rstrip("'")
+                if not allele or allele == "no":
+                    continue
+                columns["sample"].append(results_dir)
+                columns["locus"].append(locus)
+                columns["allele"].append(allele)
+                columns["confidence"].append(float(confidence) if confidence else None)
+    return pd.DataFrame(columns, columns=SEQ2HLA_COLUMNS)
+
+
+VCF_COLUMNS = ["chrom", "pos", "ref", "alt", "filter"]
+
+
+def iter_vcf_records(vcf_path):
+    """
+    Stream (chrom, pos, ref, alt, filter) records from a (possibly gzipped) VCF,
+    one line at a time. Records with several ALT alleles yield one record per allele.
+    """
+    open_fn = gzip.open if vcf_path.endswith(".gz") else open
+    with open_fn(vcf_path, "rt") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t", 7)
+            if len(fields) < 5:
+                continue
+            chrom, pos, _, ref, alts = fields[:5]
+            vcf_filter = fields[6] if len(fields) > 6 else "."
+            for alt in alts.split(","):
+                yield chrom, int(pos), ref, alt, vcf_filter
+
+
+def read_kallisto_abundance(abundance_path, value="tpm"):
+    """
+    Read one column (e.g. "tpm" or "est_counts") of a Kallisto abundance.tsv as a float32
+    Series indexed by target_id.
+    """
+    df = pd.read_csv(abundance_path, sep="\t", usecols=["target_id", value],
+                     dtype={"target_id": str, value: "float32"})
+    return pd.Series(df[value].values, index=df.target_id.values, name=abundance_path)
@@ -14,21 +14,374 @@
 
 from __future__ import print_function
 
-from subprocess import check_call
-from os import environ, path
+from subprocess import check_call, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+import os
+from os import environ, path, makedirs
+import hashlib
+import json
+import shlex
 import time
 from types import FunctionType
+import pandas as pd
+
+from .config import Config
+from .progress import Progress
+from .utils import get_cli_args, get_logger, atomic_write
+
+VALID_ARG_TYPES = (bool, int, float, str)
+JOB_ARRAY_FORMATS = ["parallel", "xargs", "slurm", "sge"]
+
+# Array job scripts: each task runs one line of the task file, by its (1-based) index.
+JOB_ARRAY_SCRIPTS = {
+    "slurm": (
+        "#!/bin/bash\n"
+        "#SBATCH --job-name={name}\n"
+        "#SBATCH --array=1-{num_tasks}\n"
+        "eval \"$(sed -n \"${{SLURM_ARRAY_TASK_ID}}p\" {tasks_path})\"\n"),
+    "sge": (
+        "#!/bin/bash\n"
+        "#$ -N {name}\n"
+        "#$ -t 1-{num_tasks}\n"
+        "#$ -cwd\n"
+        "eval \"$(sed -n \"${{SGE_TASK_ID}}p\" {tasks_path})\"\n"),
+}
+
+logger = get_logger(__name__)
+
+
+def render_keyword_args(config, patient):
+    """
+    Render a Config's arg_* values for a patient as CLI arguments.
+    """
+    keyword_args = []
+
+    # If an argument has a None value, skip it.
+    # If an argument has a boolean value, include it as --arg if True.
+    # If an argument has a non-boolean value, include it as --arg=<value>.
+    for attr in dir(config):
+        if attr.startswith("arg_"):
+            value = getattr(config, attr)
+            value = value(patient) # Always will be f(patient)
+            if value is not None:
+                arg_name = attr.split("arg_")[1]
+                arg_name = arg_name.replace("_", "-")
+                if value == True:
+                    keyword_args.append("--{}".format(arg_name))
+                elif type(value) != bool:
+                    keyword_args.append("--{}={}".format(arg_name, value))
+    return keyword_args
+
+
+def biokepi_environ(work_dir, shared_work_dir):
+    """
+    The environment Pipeline.run launches a patient with: its work dir, plus the
+    toolkit, pyensembl cache and reference genomes of shared_work_dir (the
+    BIOKEPI_WORK_DIR that was set before the run).
+    """
+    return [
+        ("BIOKEPI_WORK_DIR", work_dir),
+        ("INSTALL_TOOLS_PATH", path.join(shared_work_dir, "toolkit")),
+        ("PYENSEMBL_CACHE_DIR", path.join(shared_work_dir, "pyensembl-cache")),
+        ("REFERENCE_GENOME_PATH", path.join(shared_work_dir, "reference-genome")),
+    ]
+
+
+def assign_work_dirs(patients, work_dirs):
+    """
+    Map from patient to the appropriate work dir, spreading patients evenly across work dirs.
+    """
+    num_chunks = len(work_dirs)
+    return_dict = {}
+    for i, work_dir in enumerate(work_dirs):
+        for item in patients[i::num_chunks]:
+            return_dict[item] = work_dir
+    return return_dict
 
 
 class Pipeline(object):
-    def __init__(self, pipeline_path, config, batch_size, batch_wait_secs):
+    def __init__(self, pipeline_path, config, batch_size, batch_wait_secs, name=None):
         self.config = config
         self.pipeline_path = pipeline_path
         self.batch_size = batch_size
         self.batch_wait_secs = batch_wait_secs
+        self.name = name
+
+    def command(self, patient):
+        """
+        Build up the full command (argv) for a patient.
+        """
+        command = ["ocaml", self.pipeline_path] + render_keyword_args(self.config, patient)
+
+        # Anonymous args (non-keyword args) have no key/value.
+        for anon_arg in self.config.anonymous_args(patient):
+            if type(anon_arg) == FunctionType:
+                anon_arg = anon_arg(patient)
+            command.append(anon_arg)
+
+        return command
+
+    def run_name(self, patient):
+        """
+        The patient's run name: its first anonymous argument (e.g. Epidisco's run name),
+        under which its outputs are written.
+        """
+        anon_args = [anon_arg(patient) if type(anon_arg) == FunctionType else anon_arg
+                     for anon_arg in self.config.anonymous_args(patient)]
+        if not anon_args:
+            raise ValueError("Pipeline {} has no run name (anonymous argument) for patient {}".
+                             format(self.name, patient.id))
+        return anon_args[0]
+
+    def validate(self, discohort, known_args=None, max_workers=16):
+        """
+        Evaluate every arg_* for every kept patient (in parallel), after giving the config
+        the patient's work dir (as run does), and return a DataFrame with one row per
+        problem found:
+
+        - given_work_dir or arguments that raise an error, or arguments with an
+          unexpected type
+        - Required arguments (Config.required_args) that are None
+        - Non-boolean values that render as e.g. --flag=False or as a bare --flag
+        - Arguments that the pipeline script's CLI doesn't know about
+        - Run names (see run_name) that are shared between patients
+
+        known_args are the CLI's argument names; if None, they're taken from the
+        script's --help output, when available.
+        """
+        if known_args is None:
+            try:
+                known_args = get_cli_args(self.pipeline_path)
+            except (CalledProcessError, OSError) as e:
+                logger.warning("Not checking CLI arguments of {}: {}".format(self.pipeline_path, e))
+        arg_attrs = [attr for attr in dir(self.config) if attr.startswith("arg_")]
+
+        patients = list(discohort.view(self.config.keep))
+        patient_to_work_dir = assign_work_dirs(patients, discohort.biokepi_work_dirs)
+        if type(self.config).given_work_dir is not Config.given_work_dir:
+            # The config may keep the work dir for its arg_* to use, so evaluate one
+            # patient at a time.
+            max_workers = 1
+
+        def evaluate(patient):
+            try:
+                self.config.given_work_dir(patient, patient_to_work_dir[patient])
+                work_dir_error = None
+            except Exception as e:
+                work_dir_error = e
+            values = {}
+            for attr in arg_attrs:
+                try:
+                    values[attr] = getattr(self.config, attr)(patient)
+                except Exception as e:
+                    values[attr] = e
+            try:
+                anon_args = [anon_arg(patient) if type(anon_arg) == FunctionType else anon_arg
+                             for anon_arg in self.config.anonymous_args(patient)]
+            except Exception as e:
+                anon_args = e
+            return work_dir_error, values, anon_args
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            evaluated = list(executor.map(evaluate, patients))
+        finally:
+            executor.shutdown()
+
+        problems = []
+        def add_problem(patient, arg, value, problem):
+            problems.append({"patient_id": patient.id, "arg": arg, "value": value,
+                             "problem": problem})
+
+        run_name_to_patients = defaultdict(list)
+        for patient, (work_dir_error, values, anon_args) in zip(patients, evaluated):
+            if work_dir_error is not None:
+                add_problem(patient, "given_work_dir", patient_to_work_dir[patient],
+                            "Raised {}".format(repr(work_dir_error)))
+            required_args = self.config.required_args(patient)
+            for attr, value in sorted(values.items()):
+                arg_name = attr.split("arg_")[1].replace("_", "-")
+                if isinstance(value, Exception):
+                    add_problem(patient, attr, None, "Raised {}".format(repr(value)))
+                elif value is None:
+                    if attr in required_args:
+                        add_problem(patient, attr, value, "Required argument is None")
+                elif not isinstance(value, VALID_ARG_TYPES):
+                    add_problem(patient, attr, value,
+                                "Unexpected type {}".format(type(value).__name__))
+                elif type(value) != bool and str(value) in ["True", "False"]:
+                    add_problem(patient, attr, value,
+                                "Non-boolean renders as --{}={}".format(arg_name, value))
+                elif type(value) != bool and value == True:
+                    add_problem(patient, attr, value,
+                                "Non-boolean renders as a bare --{}".format(arg_name))
+                elif (known_args is not None and arg_name not in known_args and
+                      value is not False):
+                    add_problem(patient, attr, value,
+                                "Unknown argument --{} for {}".format(arg_name, self.pipeline_path))
+
+            if isinstance(anon_args, Exception):
+                add_problem(patient, "anonymous_args", None, "Raised {}".format(repr(anon_args)))
+            elif anon_args:
+                # Other anonymous arguments (e.g. a constant positional) may well be shared.
+                run_name_to_patients[anon_args[0]].append(patient)
+
+        for run_name, run_name_patients in run_name_to_patients.items():
+            if len(run_name_patients) > 1:
+                for patient in run_name_patients:
+                    add_problem(patient, "run_name", run_name,
+                                "Shared with patients {}".format(
+                                    [other.id for other in run_name_patients if other is not patient]))
 
-    def run(self, discohort, skip_num, wait_after_all, dry_run):
+        return pd.DataFrame(problems, columns=["patient_id", "arg", "value", "problem"])
+
+    def pipeline_hash(self):
+        """
+        Hash of the pipeline script's contents, or of its path if it can't be read.
+        """
+        try:
+            with open(self.pipeline_path, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except (IOError, OSError):
+            return hashlib.sha1(self.pipeline_path.encode("utf-8")).hexdigest()
+
+    def fingerprint(self, patient, command, pipeline_hash):
+        """
+        A content fingerprint of a patient's launch: the rendered command, the pipeline
+        script and the size and mtime of the patient's inputs (e.g. BAMs).
+        """
+        input_stats = []
+        for input_path in self.config.input_paths(patient):
+            try:
+                stat = os.stat(input_path)
+                input_stats.append([input_path, stat.st_size, stat.st_mtime])
+            except OSError:
+                # e.g. a URL rather than a local path.
+                input_stats.append([input_path, None, None])
+        fingerprint_json = json.dumps([command, pipeline_hash, input_stats])
+        return hashlib.sha1(fingerprint_json.encode("utf-8")).hexdigest()
+
+    def input_bytes(self, patient):
+        """
+        Total size of the patient's inputs that are local paths.
+        """
+        total = 0
+        for input_path in self.config.input_paths(patient):
+            try:
+                total += os.stat(input_path).st_size
+            except OSError:
+                pass
+        return total
+
+    def record_path(self, discohort, record="fingerprints"):
+        if self.name is None:
+            raise ValueError("Launch records require a named Pipeline")
+        return path.join(discohort.cache_dir, record, "{}.json".format(self.name))
+
+    def load_record(self, discohort, record="fingerprints"):
+        """
+        Map from patient ID to a record of its last successful launch, e.g. its
+        fingerprint for "fingerprints".
+        """
+        record_path = self.record_path(discohort, record)
+        if not path.exists(record_path):
+            return {}
+        with open(record_path) as f:
+            return json.load(f)
+
+    def save_record(self, discohort, values, record="fingerprints"):
+        record_path = self.record_path(discohort, record)
+        if not path.exists(path.dirname(record_path)):
+            makedirs(path.dirname(record_path))
+        with atomic_write(record_path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(values, f, indent=2, sort_keys=True)
+
+    def load_fingerprints(self, discohort):
+        return self.load_record(discohort, "fingerprints")
+
+    def export_job_array(self, discohort, tasks_path, format="parallel", only_changed=False):
+        """
+        Write every kept patient's command, with its environment (see biokepi_environ), to
+        tasks_path, one task per patient, in the same order and with the same work dirs as
+        run, for launching with other tools:
+
+        - "parallel": one shell command per line, e.g. for parallel -j 8 < tasks_path.
+        - "xargs": the same, NUL-separated, e.g. for xargs -0 -n 1 -P 8 sh -c < tasks_path.
+        - "slurm" or "sge": one shell command per line, plus an array job script
+          (<tasks_path>.sh) whose task N runs line N, e.g. for sbatch <tasks_path>.sh.
+          With no tasks, there is no array job script.
+
+        If only_changed is True, only patients whose fingerprint changed since their last
+        successful launch are written. Nothing is recorded as launched.
+
+        Returns a DataFrame of each task's (1-based) index, patient_id and work_dir.
+        """
+        if format not in JOB_ARRAY_FORMATS:
+            raise ValueError("Invalid job array format {}; expected one of {}".format(
+                format, JOB_ARRAY_FORMATS))
+
+        shared_work_dir = environ["BIOKEPI_WORK_DIR"]
+        patient_subset = list(discohort.view(self.config.keep))
+        patient_to_work_dir = assign_work_dirs(patient_subset, discohort.biokepi_work_dirs)
+        if only_changed:
+            pipeline_hash = self.pipeline_hash()
+            last_fingerprints = self.load_fingerprints(discohort)
+
+        tasks = []
+        rows = []
+        for patient in patient_subset:
+            work_dir = patient_to_work_dir[patient]
+            self.config.given_work_dir(patient, work_dir)
+            command = self.command(patient)
+            if only_changed and last_fingerprints.get(str(patient.id)) == self.fingerprint(
+                    patient, command, pipeline_hash):
+                continue
+            env = ["{}={}".format(key, shlex.quote(value))
+                   for key, value in biokepi_environ(work_dir, shared_work_dir)]
+            tasks.append(" ".join(["env"] + env + [shlex.quote(str(arg)) for arg in command]))
+            rows.append({"task": len(tasks), "patient_id": patient.id, "work_dir": work_dir})
+
+        tasks_dir = path.dirname(path.abspath(tasks_path))
+        if not path.exists(tasks_dir):
+            makedirs(tasks_dir)
+        with open(tasks_path, "w") as f:
+            separator = "\0" if format == "xargs" else "\n"
+            f.write("".join(task + separator for task in tasks))
+        if format in JOB_ARRAY_SCRIPTS and not tasks:
+            # An array of no tasks (e.g. --array=1-0) is invalid, so there's no script to
+            # submit; remove one left from an earlier export, which would run stale tasks.
+            if path.exists(tasks_path + ".sh"):
+                os.remove(tasks_path + ".sh")
+            print("No tasks to export, so not writing {}".format(tasks_path + ".sh"))
+        elif format in JOB_ARRAY_SCRIPTS:
+            with open(tasks_path + ".sh", "w") as f:
+                f.write(JOB_ARRAY_SCRIPTS[format].format(
+                    name=self.name or "discohorts", num_tasks=len(tasks),
+                    tasks_path=shlex.quote(path.abspath(tasks_path))))
+        print("Wrote {} tasks to {}".format(len(tasks), tasks_path))
+        return pd.DataFrame(rows, columns=["task", "patient_id", "work_dir"])
+
+    def run(self, discohort, skip_num, wait_after_all, dry_run, only_changed=False,
+            patient_to_work_dir=None, launched=None, progress=True, target_per_min=None):
+        """
+        Launch the pipeline for every kept patient.
+
+        Every launch is recorded in the Discohort's RunHistory, and every successful one
+        records a fingerprint and time for the patient. If only_changed
+        is True, skip patients whose fingerprint matches their last successful launch.
+
+        patient_to_work_dir overrides the default work dir assignment, and launched
+        is a dict from (work_dir, command) to the pipeline name that launched it,
+        shared across runs (e.g. of a sweep) so that identical commands only run once.
+
+        If progress is True, report launch throughput, ETA and time spent in batch waits,
+        overall and per work dir, and how far launches are behind target_per_min (by
+        default, batch_size per batch_wait_secs); see Progress.
+        """
         ran_count = 0
+        reporter = None
         original_work_dir = environ["BIOKEPI_WORK_DIR"]
         original_install_tools_path = environ.get("INSTALL_TOOLS_PATH", None)
         original_pyensembl_cache_dir = environ.get("PYENSEMBL_CACHE_DIR", None)
@@ -42,76 +395,108 @@ class Pipeline(object):
             work_dir_index = 0
 
             # Run on only the correct subset of patients.
-            patient_subset = [patient for patient in discohort.cohort if self.config.keep(patient)]
+            patient_subset = list(discohort.view(self.config.keep))
 
             # Map from patient to the appropriate work dir.
-            def get_patient_to_work_dir(patients, work_dirs):
-                num_chunks = len(work_dirs)
-                return_dict = {}
-                for i, work_dir in enumerate(work_dirs):
-                    for item in patients[i::num_chunks]:
-                        return_dict[item] = work_dir
-                return return_dict
+            if patient_to_work_dir is None:
+                patient_to_work_dir = assign_work_dirs(patient_subset, discohort.biokepi_work_dirs)
+
+            pipeline_hash = self.pipeline_hash()
+            last_fingerprints = self.load_fingerprints(discohort)
+            history = discohort.run_history()
 
-            patient_to_work_dir = get_patient_to_work_dir(patient_subset,
-                                                          discohort.biokepi_work_dirs)
+            unsaved = set()
+
+            def record_launch(patient, command):
+                last_fingerprints[str(patient.id)] = self.fingerprint(
+                    patient, command, pipeline_hash)
+                unsaved.add(str(patient.id))
+
+            def save_records():
+                # Saved after every batch and at the end, rather than after every launch.
+                if unsaved:
+                    self.save_record(discohort, last_fingerprints, "fingerprints")
+                    unsaved.clear()
+
+            if only_changed:
+                def is_changed(patient):
+                    self.config.given_work_dir(patient, patient_to_work_dir[patient])
+                    fingerprint = self.fingerprint(patient, self.command(patient), pipeline_hash)
+                    return last_fingerprints.get(str(patient.id)) != fingerprint
+
+                num_kept = len(patient_subset)
+                patient_subset = [patient for patient in patient_subset if is_changed(patient)]
+                print("Skipping {} of {} patients whose inputs and config are unchanged".format(
+                    num_kept - len(patient_subset), num_kept))
 
             # Loop over all relevant patients.
             print("Running on a patient subset of {} patients".format(len(patient_subset)))
+            if target_per_min is None and self.batch_wait_secs:
+                target_per_min = 60.0 * self.batch_size / self.batch_wait_secs
+            reporter = Progress(len(patient_subset), name=self.name, unit="launches",
+                                pools=discohort.biokepi_work_dirs, target_per_min=target_per_min,
+                                show=progress)
             for patient in patient_subset:
                 # Grab the work_dir and run an optional function that takes in work_dir as input.
                 # Also set the BIOKEPI_WORK_DIR environment variable.
                 work_dir = patient_to_work_dir[patient]
                 self.config.given_work_dir(patient, work_dir)
                 environ["BIOKEPI_WORK_DIR"] = patient_to_work_dir[patient]
-                print("Setting BIOKEPI_WORK_DIR={}".format(environ["BIOKEPI_WORK_DIR"]))
-
-                # Build up our command.
-                command = ["ocaml", self.pipeline_path]
-
-                # If an argument has a None value, skip it.
-                # If an argument has a boolean value, include it as --arg if True.
-                # If an argument has a non-boolean value, include it as --arg=<value>.
-                for attr in dir(self.config):
-                    if attr.startswith("arg_"):
-                        value = getattr(self.config, attr)
-                        value = value(patient) # Always will be f(patient)
-                        if value is not None:
-                            arg_name = attr.split("arg_")[1]
-                            arg_name = arg_name.replace("_", "-")
-                            if value == True:
-                                command.append("--{}".format(arg_name))
-                            elif type(value) != bool:
-                                command.append("--{}={}".format(arg_name, value))
-
-                # Anonymous args (non-keyword args) have no key/value.
-                for anon_arg in self.config.anonymous_args(patient):
-                    if type(anon_arg) == FunctionType:
-                        anon_arg = anon_arg(patient)
-                    command.append(anon_arg)
-
-                print("Running {}".format(" ".join(command)))
+                reporter.message("Setting BIOKEPI_WORK_DIR={}".format(environ["BIOKEPI_WORK_DIR"]))
+
+                command = self.command(patient)
+                launch_key = (work_dir, tuple(command))
+                if launched is not None and launch_key in launched:
+                    reporter.message("Already ran {} for pipeline {}; sharing its result".format(
+                        " ".join(command), launched[launch_key]))
+                    if not dry_run:
+                        record_launch(patient, command)
+                    reporter.update(pool=work_dir)
+                    continue
+
+                reporter.message("Running {}".format(" ".join(command)))
                 ran_count += 1
 
                 if ran_count <= skip_num:
-                    print("(Actually skipping this one, number {})".format(ran_count))
+                    reporter.message("(Actually skipping this one, number {})".format(ran_count))
                 else:
                     if dry_run:
-                        print("(Not actually running)")
+                        reporter.message("(Not actually running)")
                     else:
-                        check_call(command)
+                        launched_at = time.time()
+                        exit_code = None
+                        try:
+                            check_call(command)
+                            exit_code = 0
+                        except CalledProcessError as e:
+                            exit_code = e.returncode
+                            raise
+                        finally:
+                            history.record_launch(
+                                self.name, patient.id, work_dir,
+                                hashlib.sha1(json.dumps(command).encode("utf-8")).hexdigest(),
+                                self.input_bytes(patient), launched_at,
+                                time.time() - launched_at, exit_code)
+                        record_launch(patient, command)
+                    if launched is not None:
+                        launched[launch_key] = self.name
+                reporter.update(pool=work_dir)
 
                 if ran_count % self.batch_size == 0:
-                    print(
+                    reporter.message(
                         "Waiting for {} seconds after the last batch of {} ({} total submitted so far)".
                         format(self.batch_wait_secs, self.batch_size, ran_count))
-                    time.sleep(self.batch_wait_secs)
+                    save_records()
+                    reporter.wait(self.batch_wait_secs)
 
                 if wait_after_all and ran_count == len(patient_subset):
-                    print(
+                    reporter.message(
                         "Waiting for {} seconds after the cohort ended ({} total submitted so far)".
                         format(self.batch_wait_secs, ran_count))
         finally:
+            if reporter is not None:
+                save_records()
+                reporter.close()
             environ["BIOKEPI_WORK_DIR"] = original_work_dir
             if original_install_tools_path:
                 environ["INSTALL_TOOLS_PATH"] = original_install_tools_path
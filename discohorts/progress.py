@@ -0,0 +1,205 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from threading import Lock
+import sys
+import time
+import pandas as pd
+
+try:
+    from IPython import get_ipython
+    from IPython.display import display, HTML
+except ImportError:
+    get_ipython = None
+
+PROGRESS_POOL_COLUMNS = ["count", "per_min", "last_secs_ago"]
+
+
+def in_notebook():
+    if get_ipython is None:
+        return False
+    shell = get_ipython()
+    return shell is not None and "IPKernelApp" in shell.config
+
+
+def format_secs(secs):
+    if secs is None:
+        return "?"
+    secs = int(secs)
+    if secs >= 60 * 60:
+        return "{}h{:02d}m".format(secs // (60 * 60), (secs // 60) % 60)
+    if secs >= 60:
+        return "{}m{:02d}s".format(secs // 60, secs % 60)
+    return "{}s".format(secs)
+
+
+class Progress(object):
+    def __init__(self, total, name="", unit="patients", pools=[], target_per_min=None,
+                 window=50, min_render_secs=1.0, show=True):
+        """
+        Throughput and ETA of total events (e.g. launches or loads), overall and per pool
+        (e.g. work dir or results dir), with the time spent in wait and, if target_per_min
+        is given, how many events behind that rate things are.
+
+        The ETA uses the rate over the last window events. update is cheap enough to call
+        on every event, from any thread: it renders at most every min_render_secs, as a
+        single \\r-updated line on stderr, or an updating HTML table in a notebook. Print
+        any other output while it's running with message, so it doesn't run into that line.
+        """
+        self.total = total
+        self.name = name
+        self.unit = unit
+        self.target_per_min = target_per_min
+        self.min_render_secs = min_render_secs
+        self.show = show
+        self.lock = Lock()
+        self.render_lock = Lock()
+        self.start_time = time.time()
+        self.count = 0
+        self.recent = deque(maxlen=window)
+        self.pool_counts = dict((pool, 0) for pool in pools)
+        self.pool_last = {}
+        self.waited_secs = 0.0
+        self.last_render_time = None
+        self.last_line_length = 0
+        self.notebook_handle = None
+
+    def update(self, pool=None, num=1):
+        with self.lock:
+            now = time.time()
+            self.count += num
+            self.recent.append((now, self.count))
+            if pool is not None:
+                self.pool_counts[pool] = self.pool_counts.get(pool, 0) + num
+                self.pool_last[pool] = now
+            should_render = (self.last_render_time is None or self.count >= self.total or
+                             now - self.last_render_time >= self.min_render_secs)
+            if should_render:
+                self.last_render_time = now
+        if should_render:
+            self.render()
+
+    def wait(self, secs):
+        """
+        Sleep for secs, counting it as time lost to waiting.
+        """
+        self.render()
+        time.sleep(secs)
+        with self.lock:
+            self.waited_secs += secs
+
+    def rolling_per_min(self):
+        if len(self.recent) < 2:
+            elapsed = time.time() - self.start_time
+            return 60.0 * self.count / elapsed if self.count and elapsed > 0 else None
+        (first_time, first_count), (last_time, last_count) = self.recent[0], self.recent[-1]
+        if last_time <= first_time:
+            return None
+        return 60.0 * (last_count - first_count) / (last_time - first_time)
+
+    def summary(self):
+        """
+        A dict of the overall numbers, and a DataFrame of count, rate and seconds since
+        the last event for each pool.
+        """
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.start_time
+            rolling = self.rolling_per_min()
+            remaining = max(self.total - self.count, 0)
+            overall = {
+                "count": self.count,
+                "total": self.total,
+                "elapsed_secs": elapsed,
+                "per_min": 60.0 * self.count / elapsed if elapsed > 0 else None,
+                "rolling_per_min": rolling,
+                "eta_secs": 60.0 * remaining / rolling if rolling else None,
+                "waited_secs": self.waited_secs,
+                "behind_target": (self.target_per_min * elapsed / 60.0 - self.count
+                                  if self.target_per_min else None),
+            }
+            pools = pd.DataFrame(
+                [[count, 60.0 * count / elapsed if elapsed > 0 else None,
+                  now - self.pool_last[pool] if pool in self.pool_last else None]
+                 for pool, count in self.pool_counts.items()],
+                index=list(self.pool_counts.keys()), columns=PROGRESS_POOL_COLUMNS)
+        return overall, pools
+
+    def line(self, overall, pools):
+        parts = ["{}{}/{} {}".format(self.name + ": " if self.name else "", overall["count"],
+                                     overall["total"], self.unit)]
+        if overall["rolling_per_min"] is not None:
+            parts.append("{:.1f}/min".format(overall["rolling_per_min"]))
+        parts.append("ETA {}".format(format_secs(overall["eta_secs"])))
+        if overall["waited_secs"]:
+            parts.append("waited {}".format(format_secs(overall["waited_secs"])))
+        if overall["behind_target"] is not None:
+            parts.append("{:.0f} behind {:.1f}/min".format(
+                max(overall["behind_target"], 0), self.target_per_min))
+        if len(pools) > 1:
+            # The pool that has gone longest without an event is the likeliest to be stuck.
+            last_secs_ago = pools.last_secs_ago.fillna(overall["elapsed_secs"])
+            stalest = last_secs_ago.idxmax()
+            if pools.loc[stalest, "count"]:
+                parts.append("slowest {} (last {} ago)".format(
+                    stalest, format_secs(last_secs_ago[stalest])))
+            else:
+                parts.append("slowest {} (none yet)".format(stalest))
+        return ", ".join(parts)
+
+    def render(self):
+        if not self.show:
+            return
+        with self.render_lock:
+            overall, pools = self.summary()
+            text = self.line(overall, pools)
+            if in_notebook():
+                html = "<pre>{}</pre>{}".format(text, pools.to_html(float_format="{:.1f}".format))
+                if self.notebook_handle is None:
+                    self.notebook_handle = display(HTML(html), display_id=True)
+                else:
+                    self.notebook_handle.update(HTML(html))
+            else:
+                padding = " " * max(self.last_line_length - len(text), 0)
+                self.last_line_length = len(text)
+                sys.stderr.write("\r" + text + padding)
+                sys.stderr.flush()
+
+    def clear(self):
+        """
+        Erase the \\r-updated line, if any; the next render draws it again.
+        """
+        with self.render_lock:
+            if self.show and self.last_line_length and not in_notebook():
+                sys.stderr.write("\r" + " " * self.last_line_length + "\r")
+                sys.stderr.flush()
+                self.last_line_length = 0
+
+    def message(self, text):
+        """
+        Print text (to stdout) on a line of its own, rather than after the progress line.
+        """
+        self.clear()
+        sys.stdout.write(text + "\n")
+        sys.stdout.flush()
+
+    def close(self):
+        """
+        Render the final numbers.
+        """
+        self.render()
+        if self.show and not in_notebook():
+            sys.stderr.write("\n")
+            sys.stderr.flush()
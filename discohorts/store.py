@@ -0,0 +1,48 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from os import path, makedirs
+from threading import Lock
+import sqlite3
+
+
+class SQLiteStore(object):
+    # Statements that create the store's tables and indexes if they don't exist yet.
+    SCHEMA = []
+
+    def __init__(self, db_path):
+        """
+        An on-disk SQLite database at db_path (and its directory, if missing), shared
+        between threads: every use of connection must hold lock. The tables and indexes
+        in SCHEMA are created when it's opened.
+        """
+        if not path.exists(path.dirname(db_path)):
+            makedirs(path.dirname(db_path))
+        self.db_path = db_path
+        self.lock = Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+
+    def __getstate__(self):
+        # SQLite connections can't be pickled (e.g. sent to a process pool), so reconnect.
+        return {"db_path": self.db_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["db_path"])
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
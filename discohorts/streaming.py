@@ -0,0 +1,122 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from queue import Queue, Empty, Full
+from threading import Thread, Event, Lock
+import sys
+
+from .index import ResultsListing
+from .utils import scan_patient_dirs, add_patient_path
+
+# Marks the end of a queue's items.
+DONE = object()
+
+
+def _put(queue, item, stop):
+    """
+    Put an item on a bounded queue, unless the stream is stopped first.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def stream_results(results_dirs, must_contain, patient_index, patients, loads,
+                   results_index=None, max_workers=16, queue_size=64):
+    """
+    Yield (patient, [load(patient_path) for load in loads]) for each patient in patients as
+    soon as its results are loaded.
+
+    Results dirs are scanned (one thread per results dir), patients' results are loaded
+    (max_workers threads, with one walk of each patient's dir) and the caller consumes
+    results concurrently, connected by queues of at most queue_size items.
+
+    If results_index (a ResultsIndex) is given, results dirs are listed and results are
+    found from it instead of from disk.
+    """
+    patients = set(patients)
+    path_queue = Queue(maxsize=queue_size)
+    result_queue = Queue(maxsize=queue_size)
+    stop = Event()
+    seen_lock = Lock()
+    patient_to_path = {}
+
+    def scan(results_dir):
+        try:
+            for found_patient, patient_path in scan_patient_dirs(
+                    results_dir, patient_index, must_contain=must_contain,
+                    results_index=results_index):
+                if found_patient not in patients:
+                    continue
+                with seen_lock:
+                    add_patient_path(patient_to_path, found_patient, patient_path)
+                if not _put(path_queue, (found_patient, patient_path), stop):
+                    return
+        except Exception:
+            _put(result_queue, sys.exc_info(), stop)
+
+    def scan_all():
+        scanners = [Thread(target=scan, args=(results_dir, )) for results_dir in results_dirs]
+        for scanner in scanners:
+            scanner.start()
+        for scanner in scanners:
+            scanner.join()
+        for _ in range(max_workers):
+            _put(path_queue, DONE, stop)
+
+    def load_all():
+        while not stop.is_set():
+            try:
+                item = path_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if item is DONE:
+                _put(result_queue, DONE, stop)
+                return
+            patient, patient_path = item
+            try:
+                if results_index is not None:
+                    listing = results_index
+                else:
+                    listing = ResultsListing(patient_path)
+                values = [load(patient_path, results_index=listing) for load in loads]
+            except Exception:
+                _put(result_queue, sys.exc_info(), stop)
+                continue
+            if not _put(result_queue, (patient, values), stop):
+                return
+
+    threads = [Thread(target=scan_all)] + [Thread(target=load_all) for _ in range(max_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        num_done = 0
+        while num_done < max_workers:
+            item = result_queue.get()
+            if item is DONE:
+                num_done += 1
+            elif len(item) == 3:
+                # An exception from a scanner or loader.
+                raise item[1].with_traceback(item[2])
+            else:
+                yield item
+    finally:
+        # Stop the other threads too, e.g. if the caller stops consuming early.
+        stop.set()
@@ -13,12 +13,89 @@
 # limitations under the License.
 
 import re
+from contextlib import contextmanager
 from glob import glob
-from os import walk, path
+from fnmatch import fnmatch
+import os
+from os import path, scandir, rename, remove, mkdir, close
+from shutil import rmtree
+from uuid import uuid4
 import subprocess
 import pandas as pd
 import logging
 
+# Directories that never hold a patient's results but can hold large trees, skipped when
+# walking results: hidden ones (e.g. NFS .snapshot dirs, which mirror the whole tree)
+# and unfinished temporary outputs.
+RESULTS_PRUNE_PATTERNS = [".*", "*.tmp"]
+
+
+class PatientIndex(object):
+    def __init__(self, patients, id_delims, check_ambiguous=True):
+        """
+        Index patient IDs for matching against file or folder names, where an ID must be
+        delimited by one of id_delims or the start/end of the name: for each delimiter,
+        ^<id>$, ^<id>_, _<id>$ or _<id>_ (for "_").
+
+        IDs without the delimiter are looked up by splitting names on it. IDs that contain
+        the delimiter fall back to a substring check on the delimiter-padded name.
+
+        If check_ambiguous is True, IDs that other IDs' names would also match are found
+        (in ambiguous_ids) and logged.
+        """
+        self.id_delims = id_delims
+        self.patients_by_id = {}
+        for patient in patients:
+            self.patients_by_id.setdefault(str(patient.id), []).append(patient)
+
+        # Per delimiter, the IDs containing it (which can't be found by splitting on it).
+        self.padded_ids = {}
+        for delim in id_delims:
+            self.padded_ids[delim] = [
+                patient_id for patient_id in self.patients_by_id if delim in patient_id]
+
+        # IDs that would also match names made up of other IDs, e.g. "1" in "lung-1".
+        self.ambiguous_ids = {}
+        for patient_id in (self.patients_by_id if check_ambiguous else []):
+            others = [other for other in self.match_ids(patient_id) if other != patient_id]
+            if others:
+                self.ambiguous_ids[patient_id] = others
+        if self.ambiguous_ids:
+            logging.getLogger(__name__).warning(
+                "Ambiguous patient IDs (ID: other IDs it contains): {}".format(self.ambiguous_ids))
+
+        self._matches = {}
+
+    def match_ids(self, name):
+        found_ids = set()
+        for delim in self.id_delims:
+            for token in name.split(delim):
+                if token in self.patients_by_id:
+                    found_ids.add(token)
+            padded_name = "{}{}{}".format(delim, name, delim)
+            for patient_id in self.padded_ids[delim]:
+                if "{}{}{}".format(delim, patient_id, delim) in padded_name:
+                    found_ids.add(patient_id)
+        return found_ids
+
+    def find(self, name):
+        """
+        Returns the patient whose ID is present in name, or None. Raises an error if
+        multiple patients match.
+        """
+        if name not in self._matches:
+            found_patients = [patient for patient_id in sorted(self.match_ids(name))
+                              for patient in self.patients_by_id[patient_id]]
+            self._matches[name] = found_patients
+
+        found_patients = self._matches[name]
+        if len(found_patients) == 1:
+            return found_patients[0]
+        elif len(found_patients) > 1:
+            raise ValueError("Found multiple candidate patients for file/folder name {}: {}".format(
+                name, found_patients))
+        return None
+
 
 def find_patient(patients, name, id_delims):
     """
@@ -26,37 +103,165 @@ def find_patient(patients, name, id_delims):
     inside it using the appropriate delimiters.
 
     Returns the corresponding patient ID or None.
+
+    When matching many names, build a PatientIndex once and use PatientIndex.find, which
+    also checks (once) for ambiguous IDs.
     """
+    return PatientIndex(patients, id_delims, check_ambiguous=False).find(name)
 
-    def with_delims(patient_id):
-        with_delims_list = []
-        # ^<id>$, ^<id>_, _<id>$, _<id>_
-        for delim in id_delims:
-            for beginning in [delim, "^"]:
-                for end in [delim, "$"]:
-                    with_delims_list.append("{}{}{}".format(beginning, patient_id, end))
-        return with_delims_list
 
-    found_patients = []
-    for patient in patients:
-        for with_delim in with_delims(patient.id):
-            if re.search(with_delim, name):
-                found_patients.append(patient)
+def scan_patient_dirs(results_dir, patient_index, must_contain=None, results_index=None):
+    """
+    Yield (patient, patient_path) for each directory directly inside results_dir whose name
+    contains must_contain (e.g. "dna"), if given, and matches a patient in patient_index.
+
+    Directories are listed from results_index (a ResultsIndex) if given, else from disk.
+    """
+    # e.g. '/nfs-pool-2/biokepi/results/lung-322'
+    if results_index is not None:
+        patient_dirs = results_index.list_dirs(results_dir)
+    else:
+        patient_dirs = sorted(os.listdir(results_dir))
+    for patient_dir in patient_dirs:
+        # Only look for e.g. "rna" or "dna" at a time.
+        if must_contain is not None and must_contain not in patient_dir:
+            continue
 
-    if len(found_patients) == 1:
-        return found_patients[0]
-    elif len(found_patients) > 1:
-        raise ValueError("Found multiple candidate patients for file/folder name {}: {}".format(
-            name, found_patients))
-    return None
+        # Look for a patient ID in the directory name.
+        found_patient = patient_index.find(patient_dir)
+        if found_patient is not None:
+            yield found_patient, path.join(results_dir, patient_dir)
 
 
-def find_files_recursive(search_path, pattern):
+def add_patient_path(patient_to_path, patient, patient_path):
+    """
+    Map patient to patient_path, making sure we don't have multiple dirs per patient, either
+    across or within the root results directories, or e.g. RNA vs. DNA.
+    """
+    if patient in patient_to_path:
+        raise ValueError(
+            "Already have a dir for patient {} ({}), but found another dir ({})".
+            format(patient.id, patient_path, patient_to_path[patient]))
+    patient_to_path[patient] = patient_path
+
+
+def get_cli_args(pipeline_path):
+    """
+    Ask an OCaml pipeline script for its CLI arguments (via --help=plain), returning a set
+    of argument names without the leading "--".
+    """
+    output = subprocess.check_output(["ocaml", pipeline_path, "--help=plain"])
+    return set(re.findall(r"--([a-zA-Z0-9][a-zA-Z0-9-]*)", output.decode("utf-8")))
+
+
+def scan_tree(search_path, pattern="*", prune=[]):
+    """
+    Traverse a path top-down with os.scandir, yielding the DirEntry of everything
+    whose name matches pattern (a glob pattern, like the ones given to glob).
+
+    Subtrees of directories whose names match any of the prune patterns are skipped.
+    This is a generator, so callers can stop early.
+    """
+    # Like glob, only match hidden files if the pattern asks for them.
+    match_hidden = pattern.startswith(".")
+    stack = [search_path]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            entries = sorted(scandir(dir_path), key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        sub_dirs = []
+        for entry in entries:
+            if fnmatch(entry.name, pattern) and (match_hidden or not entry.name.startswith(".")):
+                yield entry
+            # DirEntry caches its type, so this doesn't need another stat.
+            if entry.is_dir(follow_symlinks=False) and not any(
+                    fnmatch(entry.name, prune_pattern) for prune_pattern in prune):
+                sub_dirs.append(entry.path)
+        stack.extend(reversed(sub_dirs))
+
+
+def scan_results_files(search_path):
+    """
+    Yield the DirEntry of every file under search_path, leaving out files and subtrees
+    whose names match RESULTS_PRUNE_PATTERNS.
+    """
+    for entry in scan_tree(search_path, prune=RESULTS_PRUNE_PATTERNS):
+        if not entry.is_dir(follow_symlinks=False) and not any(
+                fnmatch(entry.name, prune_pattern) for prune_pattern in RESULTS_PRUNE_PATTERNS):
+            yield entry
+
+
+def find_files_recursive(search_path, pattern, prune=[]):
     """
     Helper to traverse a path
     Returns list of full path to all files matching pattern
     """
-    return [y for x in walk(search_path) for y in glob(path.join(x[0], pattern))]
+    return [entry.path for entry in scan_tree(search_path, pattern=pattern, prune=prune)]
+
+
+def file_stats(dir_path):
+    """
+    Sorted (name, size, mtime) of the files directly inside dir_path, e.g. to tell
+    whether a tool's outputs changed.
+    """
+    stats = []
+    for entry in scandir(dir_path):
+        if entry.is_file():
+            entry_stat = entry.stat()
+            stats.append((entry.name, entry_stat.st_size, entry_stat.st_mtime))
+    return sorted(stats)
+
+
+@contextmanager
+def atomic_write(target_path, is_dir=False):
+    """
+    Yield the path of a new temporary file (or directory, if is_dir) next to target_path,
+    unique across threads and processes, and rename it to target_path once the block
+    succeeds, so that target_path is never seen partly written. It's removed if the block
+    fails, or if is_dir and another writer already created target_path.
+    """
+    dir_path, name = path.split(target_path)
+    # Hidden and *.tmp, so that walks of results skip it (see RESULTS_PRUNE_PATTERNS).
+    tmp_path = path.join(dir_path, ".{}.{}.tmp".format(name, uuid4().hex))
+    # Created exclusively, with the default modes, so the kernel applies the umask.
+    if is_dir:
+        mkdir(tmp_path, 0o777)
+    else:
+        close(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+
+    def discard():
+        if is_dir:
+            rmtree(tmp_path, ignore_errors=True)
+        elif path.lexists(tmp_path):
+            remove(tmp_path)
+
+    try:
+        yield tmp_path
+    except BaseException:
+        discard()
+        raise
+    try:
+        rename(tmp_path, target_path)
+    except OSError:
+        discard()
+        if not (is_dir and path.isdir(target_path)):
+            raise
+
+
+def find_files_known_layouts(search_path, layouts):
+    """
+    Look for files in known layouts (glob patterns relative to search_path), which only
+    lists the directories along the way rather than the whole tree.
+
+    Returns the sorted matches across all layouts.
+    """
+    found = set()
+    for layout in layouts:
+        found.update(glob(path.join(search_path, layout)))
+    return sorted(found)
 
 
 def run_hlarp(results_dir, caller):
@@ -68,13 +273,8 @@ def run_hlarp(results_dir, caller):
     output = subprocess.check_output(["hlarp", caller, results_dir])
     hlarp_results = output.decode("utf-8").split("\n")
     header_line = hlarp_results[0].split(",")
-    df = pd.DataFrame(columns=header_line)
-    for i, line_str in enumerate(hlarp_results[1:]):
-        if line_str == "":
-            continue
-        line = line_str.split(",")
-        df.loc[i] = line
-    return df
+    lines = [line_str.split(",") for line_str in hlarp_results[1:] if line_str != ""]
+    return pd.DataFrame(lines, columns=header_line)
 
 
 def get_logger(name, level=logging.INFO):
@@ -0,0 +1,203 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from itertools import islice
+from os import path, makedirs
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+from .parsers import iter_vcf_records, VCF_COLUMNS
+from .utils import scan_tree, atomic_write, RESULTS_PRUNE_PATTERNS
+
+# Columns stored for each variant: the VCF's own, plus the name of the VCF it came from.
+VARIANT_TABLE_COLUMNS = VCF_COLUMNS + ["source"]
+
+# How each column is stored in <column>.bin: "int64"; "category", int32 codes into a
+# vocabulary, for columns with few distinct values; or "bytes", UTF-8 values end to end
+# with their end offsets in <column>.offsets, for alleles, which can be arbitrarily long.
+VARIANT_COLUMN_STORAGE = {
+    "chrom": "category",
+    "pos": "int64",
+    "ref": "bytes",
+    "alt": "bytes",
+    "filter": "category",
+    "source": "category",
+}
+
+# Part of each table's cache key, so that tables in an older layout aren't read.
+VARIANT_TABLE_FORMAT = 2
+
+
+def map_array(file_path, dtype, length):
+    # np.memmap can't map an empty file.
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode="r", shape=(length,))
+
+
+class VariantTable(object):
+    def __init__(self, table_dir):
+        """
+        A lazy accessor for a patient's variants, stored column by column in table_dir
+        (see VARIANT_COLUMN_STORAGE). Columns are memory-mapped on access rather than read
+        up front: pos as int64, category columns as a pandas Categorical, and bytes
+        columns decoded to an object array of strings.
+        """
+        self.table_dir = table_dir
+        with open(path.join(table_dir, "table.json")) as f:
+            self.meta = json.load(f)
+
+    def column_path(self, column, extension="bin"):
+        return path.join(self.table_dir, "{}.{}".format(column, extension))
+
+    def __getitem__(self, column):
+        if column not in VARIANT_TABLE_COLUMNS:
+            raise KeyError(column)
+        length = len(self)
+        storage = VARIANT_COLUMN_STORAGE[column]
+        if storage == "int64":
+            return map_array(self.column_path(column), np.int64, length)
+        if storage == "category":
+            return pd.Categorical.from_codes(
+                map_array(self.column_path(column), np.int32, length),
+                categories=self.meta["vocabularies"][column])
+        offsets = map_array(self.column_path(column, "offsets"), np.int64, length + 1)
+        values = map_array(self.column_path(column), np.uint8, int(offsets[-1]))
+        data = values.tobytes() if len(values) else b""
+        return np.array([data[start:end].decode("utf-8")
+                         for start, end in zip(offsets[:-1], offsets[1:])], dtype=object)
+
+    def __len__(self):
+        return self.meta["length"]
+
+    def to_dataframe(self):
+        return pd.DataFrame(dict((column, self[column]) for column in VARIANT_TABLE_COLUMNS),
+                            columns=VARIANT_TABLE_COLUMNS)
+
+    def __repr__(self):
+        return "VariantTable({})".format(self.table_dir)
+
+
+def find_vcfs(patient_path, results_index=None):
+    if results_index is not None:
+        vcf_paths = [file_path for (file_path, _, _) in results_index.find_files(
+            patient_path, pattern="*.vcf*")]
+    else:
+        vcf_paths = [entry.path for entry in scan_tree(
+            patient_path, pattern="*.vcf*", prune=RESULTS_PRUNE_PATTERNS)]
+    return sorted(vcf_path for vcf_path in vcf_paths
+                  if vcf_path.endswith(".vcf") or vcf_path.endswith(".vcf.gz"))
+
+
+def write_variant_table(vcf_paths, table_dir, chunk_size=100000):
+    """
+    Stream the records of vcf_paths into table_dir, one file per column (see
+    VARIANT_COLUMN_STORAGE), appending chunk_size records at a time, so that memory use
+    doesn't grow with the number of variants.
+    """
+    records = (record + (path.basename(vcf_path), )
+               for vcf_path in vcf_paths for record in iter_vcf_records(vcf_path))
+    vocabularies = dict((column, {}) for column, storage in VARIANT_COLUMN_STORAGE.items()
+                        if storage == "category")
+    bytes_ends = dict((column, 0) for column, storage in VARIANT_COLUMN_STORAGE.items()
+                      if storage == "bytes")
+    length = 0
+
+    with atomic_write(table_dir, is_dir=True) as tmp_dir:
+        files = dict((column, open(path.join(tmp_dir, "{}.bin".format(column)), "wb"))
+                     for column in VARIANT_TABLE_COLUMNS)
+        offset_files = dict((column, open(path.join(tmp_dir, "{}.offsets".format(column)), "wb"))
+                            for column in bytes_ends)
+        try:
+            for offset_file in offset_files.values():
+                np.zeros(1, dtype=np.int64).tofile(offset_file)
+            while True:
+                chunk = list(islice(records, chunk_size))
+                if not chunk:
+                    break
+                length += len(chunk)
+                for column, values in zip(VARIANT_TABLE_COLUMNS, zip(*chunk)):
+                    storage = VARIANT_COLUMN_STORAGE[column]
+                    if storage == "int64":
+                        np.array(values, dtype=np.int64).tofile(files[column])
+                    elif storage == "category":
+                        vocabulary = vocabularies[column]
+                        np.array([vocabulary.setdefault(value, len(vocabulary))
+                                  for value in values], dtype=np.int32).tofile(files[column])
+                    else:
+                        encoded = [value.encode("utf-8") for value in values]
+                        ends = bytes_ends[column] + np.cumsum(
+                            [len(value) for value in encoded], dtype=np.int64)
+                        ends.tofile(offset_files[column])
+                        files[column].write(b"".join(encoded))
+                        bytes_ends[column] = int(ends[-1])
+        finally:
+            for f in list(files.values()) + list(offset_files.values()):
+                f.close()
+
+        with open(path.join(tmp_dir, "table.json"), "w") as f:
+            json.dump({
+                "length": length,
+                # Each vocabulary in code order.
+                "vocabularies": dict(
+                    (column, sorted(vocabulary, key=vocabulary.get))
+                    for column, vocabulary in vocabularies.items()),
+                "vcfs": vcf_paths,
+            }, f)
+
+
+def load_variants(patient_path, cache_dir, results_index=None):
+    """
+    Given a path to a Patient's results, return a VariantTable of the variants in all of
+    its VCFs, or None if it has no VCFs.
+
+    Tables are stored in cache_dir, keyed by the VCFs' paths, sizes and mtimes, so VCFs
+    are only parsed again if they change.
+    """
+    vcf_paths = find_vcfs(patient_path, results_index=results_index)
+    if not vcf_paths:
+        return None
+
+    vcf_stats = [[vcf_path, path.getsize(vcf_path), path.getmtime(vcf_path)]
+                 for vcf_path in vcf_paths]
+    key = hashlib.sha1(json.dumps([VARIANT_TABLE_FORMAT, vcf_stats]).encode(
+        "utf-8")).hexdigest()
+    table_dir = path.join(cache_dir, key)
+    if not path.exists(table_dir):
+        try:
+            makedirs(cache_dir)
+        except OSError:
+            # Already exists, possibly created by another worker.
+            pass
+        write_variant_table(vcf_paths, table_dir)
+    return VariantTable(table_dir)
+
+
+def concat_variant_tables(patients):
+    """
+    One DataFrame of the variants of every patient with a variant_table, with a
+    patient_id column.
+    """
+    dfs = []
+    for patient in patients:
+        variant_table = getattr(patient, "variant_table", None)
+        if variant_table is not None:
+            df = variant_table.to_dataframe()
+            df.insert(0, "patient_id", patient.id)
+            dfs.append(df)
+    if not dfs:
+        return pd.DataFrame(columns=["patient_id"] + VARIANT_TABLE_COLUMNS)
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,136 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+import hashlib
+import pandas as pd
+
+from .index import under_range
+from .store import SQLiteStore
+from .utils import scan_results_files
+
+HASH_BLOCK_SIZE = 64 * 1024 * 1024
+MANIFEST_COLUMNS = ["root", "rel_path", "size", "mtime", "digest", "status"]
+
+
+def hash_file(file_path, block_size=HASH_BLOCK_SIZE):
+    """
+    SHA-1 of a file, read in large blocks into a single reused buffer.
+    """
+    sha1 = hashlib.sha1()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            num_read = f.readinto(buf)
+            if not num_read:
+                break
+            sha1.update(view[:num_read])
+    return sha1.hexdigest()
+
+
+class Manifest(SQLiteStore):
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS files "
+        "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)",
+    ]
+
+    def __init__(self, db_path):
+        """
+        An on-disk (SQLite) manifest of file checksums: path, size, mtime and digest.
+        """
+        SQLiteStore.__init__(self, db_path)
+
+    def entries(self, root):
+        """
+        Map from path to (size, mtime, digest) for every file recorded under root.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime, digest FROM files WHERE path >= ? AND path < ?",
+                under_range(path.normpath(root))).fetchall()
+        return dict((file_path, (size, mtime, digest))
+                    for (file_path, size, mtime, digest) in rows)
+
+    def put(self, rows):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+
+    def remove(self, file_paths):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?", [(file_path, ) for file_path in file_paths])
+
+
+def verify_trees(roots, manifest, max_workers=None, batch_size=100):
+    """
+    Checksum every file under roots against manifest, on a pool of max_workers processes
+    (by default, one per core). Only files that are new, or whose size or mtime changed
+    since they were recorded, are read; unchanged files keep their recorded digest.
+    Hidden and temporary files (see RESULTS_PRUNE_PATTERNS) are left out.
+
+    Returns a DataFrame of root, rel_path, size, mtime, digest and status ("unchanged",
+    "new", "changed" or "missing", for recorded files that are gone), with a mismatch
+    column that is True where copies of a rel_path in several roots have different
+    sizes or digests.
+    """
+    rows = []
+    to_hash = []
+    for root in roots:
+        root = path.normpath(root)
+        recorded = manifest.entries(root)
+        for entry in scan_results_files(root):
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            row = {"root": root, "rel_path": path.relpath(entry.path, root),
+                   "size": entry_stat.st_size, "mtime": entry_stat.st_mtime}
+            last = recorded.pop(entry.path, None)
+            if last is not None and last[:2] == (row["size"], row["mtime"]):
+                row.update(digest=last[2], status="unchanged")
+            else:
+                row.update(digest=None, status="new" if last is None else "changed")
+                to_hash.append((entry.path, row))
+            rows.append(row)
+
+        for file_path, (size, mtime, digest) in sorted(recorded.items()):
+            rows.append({"root": root, "rel_path": path.relpath(file_path, root), "size": size,
+                         "mtime": mtime, "digest": digest, "status": "missing"})
+        manifest.remove(recorded.keys())
+
+    # Largest files first, so that one huge file doesn't start last and run alone.
+    to_hash.sort(key=lambda item: -item[1]["size"])
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        hashed = []
+        for (file_path, row), digest in zip(
+                to_hash, executor.map(hash_file, [file_path for file_path, _ in to_hash])):
+            row["digest"] = digest
+            hashed.append((file_path, row["size"], row["mtime"], digest))
+            # Record progress as we go, so an interrupted pass doesn't start from scratch.
+            if len(hashed) >= batch_size:
+                manifest.put(hashed)
+                hashed = []
+        manifest.put(hashed)
+    finally:
+        executor.shutdown()
+
+    df = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    present = df[df.status != "missing"]
+    copies = present.groupby("rel_path").agg({"size": "nunique", "digest": "nunique"})
+    mismatched = copies[(copies["size"] > 1) | (copies["digest"] > 1)].index
+    df["mismatch"] = df.rel_path.isin(mismatched) & (df.status != "missing")
+    return df
@@ -0,0 +1,76 @@
+# Copyright (c) 2017. Mount Sinai School of Medicine
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .utils import get_logger
+
+logger = get_logger(__name__)
+
+
+class ChangeWaiter(object):
+    def __init__(self, use_inotify=True):
+        """
+        Wait for changes in a set of directories: with inotify, if use_inotify is True and
+        inotify_simple is installed (and the platform supports it), or else by sleeping, in
+        which case callers find changes by polling.
+
+        inotify only sees changes made through the local kernel, so changes made on other
+        NFS clients still need polling; it only lets callers react sooner to local ones.
+        """
+        self.inotify = None
+        self.watched = set()
+        if use_inotify and INotify is not None:
+            try:
+                self.inotify = INotify()
+            except OSError as e:
+                logger.warning("Falling back to polling, since inotify failed: {}".format(e))
+
+    def watch(self, dir_paths):
+        """
+        Also wake up on files or directories created, written, moved into or deleted from
+        any of dir_paths (but not their subdirectories).
+        """
+        if self.inotify is None:
+            return
+        mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE
+        for dir_path in dir_paths:
+            if dir_path in self.watched:
+                continue
+            try:
+                self.inotify.add_watch(dir_path, mask)
+                self.watched.add(dir_path)
+            except OSError as e:
+                # e.g. running out of inotify watches; polling still finds the change.
+                logger.warning("Could not watch {}: {}".format(dir_path, e))
+
+    def wait(self, timeout_secs):
+        """
+        Return after timeout_secs, or as soon as a watched directory changes.
+        """
+        if self.inotify is None:
+            time.sleep(timeout_secs)
+        else:
+            # After the first event, gather the rest of its burst for up to a second.
+            self.inotify.read(timeout=int(timeout_secs * 1000),
+                              read_delay=int(min(timeout_secs, 1) * 1000))
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
@@ -65,6 +65,7 @@ if __name__ == "__main__":
             "Programming Language :: Python",
             "Topic :: Scientific/Engineering :: Bio-Informatics",
         ],
+        python_requires=">=3.5",
         install_requires=install_requires,
         dependency_links=dependency_links,
         long_description=readme,